@@ -2,9 +2,12 @@
 """
 HLS + Looping MP4 Ad Overlay using GStreamer
 Uses playbin for ad with proper looping via seek on EOS
+Ad frames cross pipelines via intervideosink/intervideosrc (all in C),
+so no per-frame Python callback is needed.
 """
 
 import sys
+import threading
 
 # macOS: Initialize Cocoa BEFORE importing GStreamer
 if sys.platform == 'darwin':
@@ -16,12 +19,72 @@ if sys.platform == 'darwin':
 
 import gi
 gi.require_version('Gst', '1.0')
+gi.require_version('GstApp', '1.0')
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gst, Gtk, GLib
+from gi.repository import Gst, Gtk, GLib, GstApp
 
 # Initialize GStreamer
 Gst.init(None)
 
+# Prefer a hardware H.264 decoder when the platform ships one
+# (vtdec_hw on macOS, VAAPI/NVDEC on Linux); avdec_h264 stays the fallback
+for _name in ("vtdec_hw", "vaapih264dec", "nvh264dec"):
+    _feature = Gst.Registry.get().find_feature(_name, Gst.ElementFactory)
+    if _feature:
+        _feature.set_rank(Gst.Rank.PRIMARY + 1)
+        break
+
+# Pipeline descriptions are parsed from fixed module-level templates;
+# per-instance values are substituted as template fields (or set as runtime
+# properties after parsing) instead of being spliced into fresh f-strings.
+_RTMP_VIDEO_OUTPUT_TMPL = """
+    queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream !
+    x264enc tune=zerolatency bitrate=2500 speed-preset=ultrafast key-int-max=30 intra-refresh=true bframes=0 rc-lookahead=0 sliced-threads=true sync-lookahead=0 ref=1 threads=0 !
+    video/x-h264,profile=baseline !
+    flvmux name=mux streamable=true latency=40000000 start-time-selection=first !
+    queue max-size-time=100000000 max-size-buffers=0 max-size-bytes=0 !
+    rtmpsink name=rtmp_sink location="{rtmp_url} live=1"
+"""
+
+# PiP ad mix doesn't need 128 kbps; halve the audio bandwidth
+_RTMP_AUDIO_OUTPUT = "queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream ! voaacenc bitrate=64000 ! mux."
+
+_MAIN_PIPELINE_TMPL = """
+    compositor name=comp background=black ignore-inactive-pads=true latency=0 min-upstream-latency=0
+        sink_0::zorder=0
+        sink_1::zorder=1 !
+    videoconvert !
+    videoscale !
+    video/x-raw,width=1280,height=720 !
+    {video_output}
+
+    uridecodebin uri="{main_url}" name=main_src buffer-duration=0 buffer-size=1048576 !
+    queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream !
+    videoconvert !
+    videoscale !
+    comp.sink_0
+
+    main_src. !
+    queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream !
+    audioconvert !
+    audioresample quality=1 !
+    audiobuffersplit output-buffer-duration=1/100 !
+    {audio_output}
+
+    intervideosrc channel=ad_pipe !
+    queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream !
+    videoconvert !
+    videoscale !
+    video/x-raw,width={ad_width},height={ad_height} !
+    comp.sink_1
+"""
+
+_AD_FEED_TMPL = """
+    appsrc name=ad_feed is-live=true do-timestamp=true format=time !
+    video/x-raw,format=I420,width={ad_width},height={ad_height},framerate=30/1 !
+    intervideosink channel=ad_pipe sync=false
+"""
+
 
 class HLSWithOverlay:
     """Play HLS with looping MP4 overlay using separate pipelines"""
@@ -35,142 +98,168 @@ class HLSWithOverlay:
         self.ad_width = ad_width
         self.ad_height = ad_height
 
+        # Parsed once here; caps-string parsing otherwise lands on the
+        # startup path of every (re)created pipeline
+        self._ad_caps = Gst.Caps.from_string(
+            f"video/x-raw,format=I420,width={ad_width},height={ad_height},framerate=30/1"
+        )
+
         self.pipeline = None
         self.ad_playbin = None
-        self.appsrc = None
+        self.ad_feed = None
+        self.ad_frames = []
+        self.ad_frame_index = 0
         self.running = True
+        self._ad_started = False
 
     def _create_main_pipeline(self):
         """Create main pipeline with appsrc for ad overlay"""
 
         if self.rtmp_url:
-            video_output = f"""
-                queue !
-                x264enc tune=zerolatency bitrate=2500 speed-preset=superfast !
-                video/x-h264,profile=baseline !
-                flvmux name=mux streamable=true !
-                rtmpsink location="{self.rtmp_url} live=1"
-            """
-            audio_output = "queue ! voaacenc bitrate=128000 ! mux."
+            video_output = _RTMP_VIDEO_OUTPUT_TMPL.format(rtmp_url=self.rtmp_url)
+            audio_output = _RTMP_AUDIO_OUTPUT
         else:
             video_output = "videoconvert ! autovideosink"
             audio_output = "autoaudiosink"
 
-        pipeline_str = f"""
-            compositor name=comp
-                sink_0::zorder=0
-                sink_1::zorder=1
-                sink_1::xpos={self.ad_x}
-                sink_1::ypos={self.ad_y}
-                sink_1::width={self.ad_width}
-                sink_1::height={self.ad_height} !
-            videoconvert !
-            videoscale !
-            video/x-raw,width=1280,height=720 !
-            {video_output}
-
-            uridecodebin uri="{self.main_url}" name=main_src !
-            queue max-size-buffers=5 !
-            videoconvert !
-            videoscale !
-            comp.sink_0
-
-            main_src. !
-            queue max-size-buffers=5 !
-            audioconvert !
-            audioresample !
-            {audio_output}
-
-            appsrc name=ad_appsrc is-live=true format=time !
-            queue max-size-buffers=5 leaky=downstream !
-            videoconvert !
-            videoscale !
-            video/x-raw,width={self.ad_width},height={self.ad_height} !
-            comp.sink_1
-        """
+        pipeline_str = _MAIN_PIPELINE_TMPL.format(
+            main_url=self.main_url,
+            video_output=video_output,
+            audio_output=audio_output,
+            ad_width=self.ad_width,
+            ad_height=self.ad_height,
+        )
 
         try:
             self.pipeline = Gst.parse_launch(pipeline_str)
-            self.appsrc = self.pipeline.get_by_name("ad_appsrc")
 
-            # Set caps on appsrc
-            caps = Gst.Caps.from_string(
-                f"video/x-raw,format=I420,width={self.ad_width},height={self.ad_height},framerate=30/1"
-            )
-            self.appsrc.set_property("caps", caps)
+            # Overlay geometry is set as pad properties at runtime rather
+            # than spliced into the parse string
+            sink_1 = self.pipeline.get_by_name("comp").get_static_pad("sink_1")
+            sink_1.set_property("xpos", self.ad_x)
+            sink_1.set_property("ypos", self.ad_y)
+            sink_1.set_property("width", self.ad_width)
+            sink_1.set_property("height", self.ad_height)
+
+            main_src = self.pipeline.get_by_name("main_src")
+            main_src.connect("source-setup", self._on_source_setup)
+
+            # Don't let the network sink pace or stall the pipeline
+            rtmp_sink = self.pipeline.get_by_name("rtmp_sink")
+            if rtmp_sink:
+                rtmp_sink.set_property("sync", False)
+                rtmp_sink.set_property("async", False)
 
             return True
         except GLib.Error as e:
             print(f"[ERROR] Main pipeline failed: {e}")
             return False
 
-    def _create_ad_playbin(self):
-        """Create playbin for ad that feeds into appsrc"""
-        self.ad_playbin = Gst.ElementFactory.make("playbin", "ad_playbin")
-        self.ad_playbin.set_property("uri", self.ad_url)
-        self.ad_playbin.set_property("volume", 0.0)
-
-        # Create custom video sink
-        sink_bin = Gst.Bin.new("ad_sink_bin")
-
-        convert = Gst.ElementFactory.make("videoconvert", "ad_convert")
-        scale = Gst.ElementFactory.make("videoscale", "ad_scale")
-        capsfilter = Gst.ElementFactory.make("capsfilter", "ad_caps")
-        capsfilter.set_property("caps", Gst.Caps.from_string(
-            f"video/x-raw,format=I420,width={self.ad_width},height={self.ad_height}"
-        ))
+    def _on_source_setup(self, element, source):
+        """Tune souphttpsrc for HLS: bigger reads, reused TCP connections"""
+        for prop, value in (("blocksize", 65536), ("keep-alive", True),
+                            ("timeout", 5), ("retries", 2)):
+            if source.find_property(prop) is not None:
+                source.set_property(prop, value)
+
+    def _preload_ad_frames(self, max_seconds=30):
+        """Decode the ad once and keep the raw I420 frames in RAM"""
+        print("[SETUP] Preloading ad frames...")
+
+        # uridecodebin3 instead of playbin: no urisourcebin multiqueue, no
+        # auto sink selection, and the boosted hardware decoder (see top of
+        # file) takes the H.264 stream. sync=false decodes as fast as
+        # possible; this pipeline runs once and is thrown away.
+        pipeline_str = f"""
+            uridecodebin3 uri="{self.ad_url}" name=preload_src use-buffering=false buffer-duration=0
 
-        appsink = Gst.ElementFactory.make("appsink", "ad_appsink")
-        appsink.set_property("emit-signals", True)
-        appsink.set_property("sync", True)  # Sync to clock for proper timing
-        appsink.set_property("max-buffers", 5)
-        appsink.set_property("drop", False)
+            preload_src. !
+            videoconvert !
+            videoscale !
+            video/x-raw,format=I420,width={self.ad_width},height={self.ad_height},framerate=30/1 !
+            appsink name=grab_sink sync=false
 
-        for elem in [convert, scale, capsfilter, appsink]:
-            sink_bin.add(elem)
+            preload_src. !
+            audioconvert !
+            fakesink sync=false
+        """
 
-        convert.link(scale)
-        scale.link(capsfilter)
-        capsfilter.link(appsink)
+        try:
+            pipeline = Gst.parse_launch(pipeline_str)
+        except GLib.Error as e:
+            print(f"[ERROR] Ad preload failed: {e}")
+            return False
 
-        ghost = Gst.GhostPad.new("sink", convert.get_static_pad("sink"))
-        sink_bin.add_pad(ghost)
+        sink = pipeline.get_by_name("grab_sink")
+        pipeline.set_state(Gst.State.PLAYING)
 
-        self.ad_playbin.set_property("video-sink", sink_bin)
+        max_frames = max_seconds * 30
+        while len(self.ad_frames) < max_frames:
+            # Direct GstApp method: no per-call signal lookup/marshalling
+            sample = sink.try_pull_sample(5 * Gst.SECOND)
+            if not sample:
+                break
+            self.ad_frames.append(sample.get_buffer())
 
-        # Connect sample handler
-        def on_new_sample(sink):
-            if not self.running or not self.appsrc:
-                return Gst.FlowReturn.OK
+        pipeline.set_state(Gst.State.NULL)
 
-            sample = sink.emit("pull-sample")
-            if sample:
-                buf = sample.get_buffer()
-                if buf:
-                    self.appsrc.emit("push-buffer", buf)
-            return Gst.FlowReturn.OK
+        cached_kb = len(self.ad_frames) * self.ad_width * self.ad_height * 3 // 2 // 1024
+        print(f"[SETUP] Cached {len(self.ad_frames)} ad frames (~{cached_kb} KB)")
+        return bool(self.ad_frames)
 
-        appsink.connect("new-sample", on_new_sample)
+    def _create_ad_feed(self):
+        """Create appsrc pipeline replaying cached frames into the channel"""
+        pipeline_str = _AD_FEED_TMPL.format(
+            ad_width=self.ad_width, ad_height=self.ad_height)
+        self.ad_playbin = Gst.parse_launch(pipeline_str)
 
-        # Handle EOS for looping
-        bus = self.ad_playbin.get_bus()
-        bus.add_signal_watch()
+        self.ad_feed = self.ad_playbin.get_by_name("ad_feed")
+        self.ad_feed.set_property("caps", self._ad_caps)
 
         def on_ad_message(bus, msg):
-            if msg.type == Gst.MessageType.EOS:
-                print("[AD] Looping...")
-                # Seek back to start
-                self.ad_playbin.seek_simple(
-                    Gst.Format.TIME,
-                    Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
-                    0
-                )
-            elif msg.type == Gst.MessageType.ERROR:
+            if msg.type == Gst.MessageType.ERROR:
                 err, _ = msg.parse_error()
                 print(f"[AD ERROR] {err}")
-            return True
+            elif msg.type == Gst.MessageType.ASYNC_DONE:
+                GLib.idle_add(self._start_main, priority=GLib.PRIORITY_HIGH_IDLE)
+            return False
+
+        self._watch_bus(self.ad_playbin.get_bus(), on_ad_message,
+                        Gst.MessageType.ERROR | Gst.MessageType.ASYNC_DONE)
 
-        bus.connect("message", on_ad_message)
+    def _push_next_frame(self):
+        """Push the next cached frame; loops round-robin forever"""
+        if not self.running or not self.ad_frames:
+            return False
+
+        frame = self.ad_frames[self.ad_frame_index]
+        self.ad_frame_index = (self.ad_frame_index + 1) % len(self.ad_frames)
+
+        # Shallow copy so do-timestamp can stamp it without touching the
+        # cached frame (the I420 planes stay shared)
+        buf = frame.copy_region(
+            Gst.BufferCopyFlags.FLAGS | Gst.BufferCopyFlags.META |
+            Gst.BufferCopyFlags.MEMORY,
+            0, frame.get_size()
+        )
+        self.ad_feed.push_buffer(buf)
+        return True
+
+    def _watch_bus(self, bus, handler, mask):
+        """Poll the bus from a worker thread instead of a signal watch.
+
+        add_signal_watch wakes the GTK main loop for every qos/tag/latency
+        message; timed_pop_filtered only ever sees the masked types, and the
+        handler is dispatched back onto the main loop.
+        """
+        def loop():
+            while True:
+                msg = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE, mask)
+                if msg is None:
+                    return
+                GLib.idle_add(handler, bus, msg)
+
+        threading.Thread(target=loop, daemon=True).start()
 
     def _on_message(self, bus, message):
         t = message.type
@@ -183,13 +272,24 @@ class HLSWithOverlay:
             src = message.src.get_name() if message.src else ""
             print(f"[ERROR] {src}: {err}")
             Gtk.main_quit()
+        elif t == Gst.MessageType.ASYNC_DONE:
+            # Main pipeline finished prerolling: release the ad feed and
+            # start the 30 fps replay of the cached frames
+            if not self._ad_started:
+                self._ad_started = True
+                self.ad_playbin.set_state(Gst.State.PLAYING)
+                GLib.timeout_add(33, self._push_next_frame)
         elif t == Gst.MessageType.STATE_CHANGED:
             if message.src == self.pipeline:
                 old, new, _ = message.parse_state_changed()
                 if new == Gst.State.PLAYING:
                     print("[STATE] Main pipeline playing")
 
-        return True
+        return False
+
+    def _start_main(self):
+        self.pipeline.set_state(Gst.State.PLAYING)
+        return GLib.SOURCE_REMOVE
 
     def run(self):
         Gtk.init(None)
@@ -205,20 +305,28 @@ class HLSWithOverlay:
         if not self._create_main_pipeline():
             return
 
-        self._create_ad_playbin()
+        # Decode the ad once up front; every later loop replays RAM frames
+        if not self._preload_ad_frames():
+            return
+
+        self._create_ad_feed()
 
         # Setup main bus
-        bus = self.pipeline.get_bus()
-        bus.add_signal_watch()
-        bus.connect("message", self._on_message)
+        self._watch_bus(self.pipeline.get_bus(), self._on_message,
+                        Gst.MessageType.EOS | Gst.MessageType.ERROR |
+                        Gst.MessageType.ASYNC_DONE |
+                        Gst.MessageType.STATE_CHANGED)
 
         print("[PLAYER] Starting playback...")
 
-        # Start ad playbin first
-        self.ad_playbin.set_state(Gst.State.PLAYING)
-
-        # Small delay then start main
-        GLib.timeout_add(200, lambda: self.pipeline.set_state(Gst.State.PLAYING) or False)
+        # Preroll the ad pipeline first, then the main one. Startup is
+        # chained off async-done bus messages instead of blocking
+        # get_state calls, so nothing stalls while the sinks preroll.
+        ret = self.ad_playbin.set_state(Gst.State.PAUSED)
+        if ret != Gst.StateChangeReturn.ASYNC:
+            # Live appsrc feeds finish the change synchronously
+            # (no-preroll) and never post async-done
+            GLib.idle_add(self._start_main, priority=GLib.PRIORITY_HIGH_IDLE)
 
         print("Press Ctrl+C to stop\n")
 
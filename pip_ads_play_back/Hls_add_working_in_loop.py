@@ -5,7 +5,9 @@ Uses decoupled pipelines: Main Pipeline (appsrc) + Ad Pipeline (appsink)
 Ensures HLS/SRT live stream never reaches EOS while ads loop at intervals.
 """
 
+import gc
 import sys
+import threading
 import time
 
 # macOS: Initialize Cocoa BEFORE importing GStreamer
@@ -18,11 +20,20 @@ if sys.platform == 'darwin':
 
 import gi
 gi.require_version('Gst', '1.0')
+gi.require_version('GstApp', '1.0')
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gst, Gtk, GLib
+from gi.repository import Gst, GstApp, Gtk, GLib
 
 Gst.init(None)
 
+# Prefer a hardware H.264 decoder when the platform ships one
+# (vtdec_hw on macOS, VAAPI/NVDEC on Linux); avdec_h264 stays the fallback
+for _name in ("vtdec_hw", "vaapih264dec", "nvh264dec"):
+    _feature = Gst.Registry.get().find_feature(_name, Gst.ElementFactory)
+    if _feature:
+        _feature.set_rank(Gst.Rank.PRIMARY + 1)
+        break
+
 def log(msg):
     print(f"[{time.strftime('%H:%M:%S')}] {msg}")
 
@@ -39,48 +50,73 @@ class DecoupledAdCompositor:
         self.ad_height = ad_height
         self.interval = interval
 
+        # Parsed once here; caps-string parsing otherwise lands on the
+        # startup path of every (re)created pipeline
+        self._ad_caps = Gst.Caps.from_string(
+            f"video/x-raw,format=I420,width={ad_width},height={ad_height},framerate=30/1"
+        )
+
         self.main_pipeline = None
         self.ad_pipeline = None
         self.appsrc = None
         self.ad_running = False
         self.restart_timer_id = None
         self.retry_count = 0
+        # Rejected pushes can repeat at frame rate while the pipeline is
+        # already struggling; log them at most once a second
+        self._last_reject_log = 0.0
+        # Toggled by the appsrc's need-data/enough-data signals: real
+        # backpressure from the consumer, instead of doing the pool and
+        # push work only to have the leaky queue throw the frame away
+        self._ad_can_push = True
+
+    def _on_source_setup(self, element, source):
+        """Tune souphttpsrc for HLS: bigger reads, reused TCP connections"""
+        for prop, value in (("blocksize", 65536), ("keep-alive", True),
+                            ("timeout", 5), ("retries", 2)):
+            if source.find_property(prop) is not None:
+                source.set_property(prop, value)
 
     def _on_main_pad_added(self, element, pad):
+        # Both targets taken: skip the caps fetch/parse for the extra
+        # tracks (subtitles, alternate audio) the decoder announces
+        if self._main_video_sink_pad.is_linked() and self._audio_sink_pad.is_linked():
+            return
         caps = pad.get_current_caps()
         if not caps: return
         name = caps.get_structure(0).get_name()
         
         if name.startswith("video"):
-            sink = self.main_pipeline.get_by_name("main_video_queue").get_static_pad("sink")
-            if not sink.is_linked():
-                pad.link(sink)
+            if not self._main_video_sink_pad.is_linked():
+                pad.link(self._main_video_sink_pad)
                 log("[MAIN] Video linked")
         elif name.startswith("audio"):
-            sink = self.main_pipeline.get_by_name("audio_queue").get_static_pad("sink")
-            if not sink.is_linked():
-                pad.link(sink)
+            if not self._audio_sink_pad.is_linked():
+                pad.link(self._audio_sink_pad)
                 log("[MAIN] Audio linked")
 
     def _create_main_pipeline(self):
+        # No videoconvert/videoscale after comp: the capsfilter makes the
+        # compositor blend straight into a 1280x720 canvas the sink accepts,
+        # saving a full-frame copy per output frame
         pipeline_str = f"""
-            compositor name=comp
+            compositor name=comp background=black ignore-inactive-pads=true latency=0 min-upstream-latency=0
                 sink_0::zorder=0
                 sink_1::zorder=100
                 sink_1::xpos={self.ad_x}
                 sink_1::ypos={self.ad_y}
                 sink_1::width={self.ad_width}
                 sink_1::height={self.ad_height} !
-            videoconvert ! videoscale ! video/x-raw,width=1280,height=720 ! autovideosink
+            video/x-raw,width=1280,height=720 ! autovideosink
             
-            uridecodebin uri="{self.main_url}" name=main_src
+            uridecodebin uri="{self.main_url}" name=main_src buffer-duration=0 buffer-size=1048576
             
-            main_src. ! queue name=main_video_queue max-size-buffers=10 ! videoconvert ! videoscale ! comp.sink_0
-            main_src. ! queue name=audio_queue max-size-buffers=10 ! audioconvert ! audioresample ! autoaudiosink
+            main_src. ! queue name=main_video_queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream ! videoconvert ! videoscale ! comp.sink_0
+            main_src. ! queue name=audio_queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream ! audioconvert ! audioresample ! autoaudiosink
             
-            appsrc name=ad_appsrc is-live=true do-timestamp=true format=time !
+            appsrc name=ad_appsrc is-live=true do-timestamp=true format=time min-latency=0 max-latency=0 !
             video/x-raw,format=I420,width={self.ad_width},height={self.ad_height} !
-            queue name=ad_queue max-size-buffers=10 leaky=downstream !
+            queue name=ad_queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream !
             videoconvert ! videoscale ! video/x-raw,width={self.ad_width},height={self.ad_height} !
             comp.sink_1
         """
@@ -88,16 +124,40 @@ class DecoupledAdCompositor:
         self.appsrc = self.main_pipeline.get_by_name("ad_appsrc")
         
         # Explicitly set caps on appsrc to avoid negotiation failure
-        caps = Gst.Caps.from_string(f"video/x-raw,format=I420,width={self.ad_width},height={self.ad_height},framerate=30/1")
-        self.appsrc.set_property("caps", caps)
+        self.appsrc.set_property("caps", self._ad_caps)
+        # Keep the hand-off allocation-free: never block the ad thread and
+        # cap the internal queue by buffer count instead of bytes
+        self.appsrc.set_property("block", False)
+        self.appsrc.set_property("max-bytes", 4 * self.ad_width * self.ad_height * 3 // 2)
+        self.appsrc.set_property("max-buffers", 4)
+        self.appsrc.set_property("leaky-type", 2)  # leak downstream, never stall the ad thread
+        self.appsrc.connect("need-data", self._on_ad_need_data)
+        self.appsrc.connect("enough-data", self._on_ad_enough_data)
+
         
+        # Cache pad handles once; get_by_name walks the whole bin tree
+        # on every call
+        self._main_video_sink_pad = self.main_pipeline.get_by_name("main_video_queue").get_static_pad("sink")
+        self._audio_sink_pad = self.main_pipeline.get_by_name("audio_queue").get_static_pad("sink")
+
         # Connect pad-added for uridecodebin
         main_src = self.main_pipeline.get_by_name("main_src")
         main_src.connect("pad-added", self._on_main_pad_added)
+        main_src.connect("source-setup", self._on_source_setup)
 
+        # Poll the main bus from a worker thread: qos/tag/latency spam
+        # never wakes the GTK main loop, only EOS/ERROR get dispatched
         bus = self.main_pipeline.get_bus()
-        bus.add_signal_watch()
-        bus.connect("message", self._on_main_message)
+        threading.Thread(target=self._main_bus_loop, args=(bus,), daemon=True).start()
+
+    def _main_bus_loop(self, bus):
+        """Blocking bus poll; masked messages are handed to the main loop"""
+        mask = Gst.MessageType.EOS | Gst.MessageType.ERROR
+        while True:
+            msg = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE, mask)
+            if msg is None:
+                return
+            GLib.idle_add(self._on_main_message, bus, msg)
 
     def _on_main_message(self, bus, msg):
         if msg.type == Gst.MessageType.EOS:
@@ -109,68 +169,88 @@ class DecoupledAdCompositor:
             # during dynamic pipeline changes. We treat it as a warning to avoid crashing.
             if "Quit requested" in str(err):
                 log(f"[MAIN WARNING] Transient sink error ignored: {err}")
-                return True
+                return False
             log(f"[MAIN ERROR] {err}: {debug}")
             Gtk.main_quit()
-        return True
+        return False
 
     def _create_ad_pipeline(self):
-        """Create separate pipeline for ad playback using playbin for robustness"""
-        # Create appsink first
-        appsink = Gst.ElementFactory.make("appsink", "ad_sink")
+        """Create separate hand-built ad pipeline (uridecodebin3 + appsink)"""
+        # Hand-built pipeline: skips playbin's urisourcebin multiqueue and
+        # lets the boosted hardware decoder (see top of file) take the
+        # stream. Audio is decoded straight into a fakesink (silent ad).
+        pipeline_str = f"""
+            uridecodebin3 uri="{self.ad_url}" name=ad_src use-buffering=false buffer-duration=0
+
+            ad_src. ! queue name=ad_queue ! videoconvert ! videoscale !
+            video/x-raw,width={self.ad_width},height={self.ad_height},format=I420 !
+            appsink name=ad_sink
+
+            ad_src. ! audioconvert ! fakesink sync=false
+        """
+        self.ad_pipeline = Gst.parse_launch(pipeline_str)
+
+        appsink = self.ad_pipeline.get_by_name("ad_sink")
         appsink.set_property("emit-signals", True)
         appsink.set_property("sync", True)
-        appsink.set_property("max-buffers", 5)
+        # One queued buffer, dropped when stale: the overlay always gets
+        # the freshest decoded frame and the sample queue adds at most
+        # one frame interval of latency
+        appsink.set_property("max-buffers", 1)
         appsink.set_property("drop", True)
+        appsink.set_property("wait-on-eos", False)
         appsink.connect("new-sample", self._on_new_ad_sample)
 
-        # Build sink bin for playbin
-        sink_bin = Gst.Bin.new("ad_sink_bin")
-        queue = Gst.ElementFactory.make("queue", "ad_queue")
-        convert = Gst.ElementFactory.make("videoconvert", "ad_convert")
-        scale = Gst.ElementFactory.make("videoscale", "ad_scale")
-        caps = Gst.ElementFactory.make("capsfilter", "ad_caps")
-        caps.set_property("caps", Gst.Caps.from_string(
-            f"video/x-raw,width={self.ad_width},height={self.ad_height},format=I420"
-        ))
-
-        for elem in [queue, convert, scale, caps, appsink]:
-            sink_bin.add(elem)
-        
-        queue.link(convert)
-        convert.link(scale)
-        scale.link(caps)
-        caps.link(appsink)
-
-        ghost = Gst.GhostPad.new("sink", queue.get_static_pad("sink"))
-        sink_bin.add_pad(ghost)
-
-        # Create playbin
-        self.ad_pipeline = Gst.ElementFactory.make("playbin", "ad_playbin")
-        self.ad_pipeline.set_property("uri", self.ad_url)
-        self.ad_pipeline.set_property("video-sink", sink_bin)
-        self.ad_pipeline.set_property("volume", 0.0) # Silent ad
-
         bus = self.ad_pipeline.get_bus()
         bus.add_signal_watch()
         bus.connect("message", self._on_ad_message)
 
+    def _on_ad_need_data(self, src, length):
+        self._ad_can_push = True
+
+    def _on_ad_enough_data(self, src):
+        self._ad_can_push = False
+
     def _on_new_ad_sample(self, appsink):
-        if not self.ad_running or not self.appsrc:
+        if not self.ad_running or not self.appsrc or not self._ad_can_push:
+            # While the consumer is full, samples stay in the appsink
+            # and its max-buffers=1 drop=true sheds them cheaply
             return Gst.FlowReturn.OK
         
-        sample = appsink.emit("pull-sample")
-        if sample:
+        # Drain everything the appsink has queued in one pass: when the
+        # main loop was briefly busy several samples pile up, and one
+        # push_buffer_list hand-off amortizes the per-buffer round-trip
+        buflist = None
+        sample = appsink.pull_sample()
+        while sample:
             buf = sample.get_buffer()
+            # Fresh lightweight header around the decoder's I420 planes,
+            # attached by reference: no plane memcpy, and the new header
+            # is writable for re-timestamping. (A pooled header would
+            # come back flagged TAG_MEMORY after replace_all_memory and
+            # the pool frees such buffers instead of recycling them.)
+            shared = Gst.Buffer.new()
+            shared.replace_all_memory(buf.get_all_memory())
             # Clear timestamps to let appsrc (do-timestamp=true) handle it
-            buf.pts = Gst.CLOCK_TIME_NONE
-            buf.dts = Gst.CLOCK_TIME_NONE
-            buf.duration = Gst.CLOCK_TIME_NONE
-            
-            # Push buffer to main pipeline appsrc
-            ret = self.appsrc.emit("push-buffer", buf)
+            shared.pts = Gst.CLOCK_TIME_NONE
+            shared.dts = Gst.CLOCK_TIME_NONE
+            shared.duration = Gst.CLOCK_TIME_NONE
+            if buflist is None:
+                buflist = Gst.BufferList.new()
+            buflist.insert(-1, shared)
+            # Release our refs before pulling more; the list holds its
+            # own and lingering Python refs keep whole I420 frames alive
+            del sample, buf, shared
+            sample = appsink.try_pull_sample(0)
+        
+        if buflist is not None:
+            ret = self.appsrc.push_buffer_list(buflist)
             if ret != Gst.FlowReturn.OK:
-                log(f"[AD] Push rejected: {ret}")
+                now = time.monotonic()
+                if now - self._last_reject_log > 1.0:
+                    self._last_reject_log = now
+                    log(f"[AD] Push rejected: {ret}")
+            del buflist
         return Gst.FlowReturn.OK
 
     def _on_ad_message(self, bus, msg):
@@ -217,6 +297,9 @@ class DecoupledAdCompositor:
         self.ad_running = True
         self.ad_pipeline.set_state(Gst.State.PLAYING)
 
+        # Safety net against buffer-ref pile-ups across ad cycles
+        GLib.timeout_add_seconds(5, lambda: (gc.collect(), True)[1])
+
         try:
             Gtk.main()
         except KeyboardInterrupt:
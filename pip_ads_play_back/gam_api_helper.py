@@ -1,4 +1,6 @@
 import os
+import urllib.parse
+from functools import lru_cache
 try:
     from googleads import ad_manager, oauth2
     HAS_GOOGLEADS = True
@@ -17,6 +19,22 @@ class GAMAPIHelper:
         self.mock = mock
         self.client = None
 
+        # Everything except the ad unit path is constant for this network,
+        # so the query string is partially evaluated once here
+        fixed_params = {
+            "sz": "640x480",
+            "gdfp_req": "1",
+            "env": "vp",
+            "output": "vast",
+            "unviewed_position_start": "1",
+        }
+        self._vast_base = (
+            "https://pubads.g.doubleclick.net/gampad/ads"
+            f"?iu=/{self.network_code}/{{path}}"
+            f"&{urllib.parse.urlencode(fixed_params)}"
+            "&correlator="  # To be filled by the player
+        )
+
     def authenticate(self):
         """Authenticate using Service Account JSON key (or Mock)"""
         if self.mock:
@@ -47,40 +65,38 @@ class GAMAPIHelper:
             print(f"[GAM API MOCK] Generating VAST tag for Ad Unit: {ad_unit_path}")
             # Return same sample but labeled as mock
             return f"https://pubads.g.doubleclick.net/gampad/ads?iu=/{self.network_code}/{ad_unit_path}&sz=640x480&cust_params=sample_ct%3Dlinear&ciu_szs=300x250%2C728x90&gdfp_req=1&output=vast&unviewed_position_start=1&env=vp&impl=s&correlator="
-        
-        base_url = "https://pubads.g.doubleclick.net/gampad/ads"
-        params = {
-            "iu": f"/{self.network_code}/{ad_unit_path}",
-            "sz": "640x480",
-            "gdfp_req": "1",
-            "env": "vp",
-            "output": "vast",
-            "unviewed_position_start": "1",
-            "correlator": "" # To be filled by the player
-        }
-        
-        query_str = "&".join([f"{k}={v}" for k, v in params.items()])
-        return f"{base_url}?{query_str}"
 
-    def list_ad_units(self):
-        """Fetch list of ad units for verification"""
+        return self._build_vast_tag_url(ad_unit_path)
+
+    @lru_cache(maxsize=256)
+    def _build_vast_tag_url(self, ad_unit_path):
+        # '/' stays unescaped: it separates levels of the ad unit hierarchy
+        return self._vast_base.format(path=urllib.parse.quote(ad_unit_path, safe='/'))
+
+    def iter_ad_units(self):
+        """Yield ad units lazily, one page of results at a time"""
         if self.mock:
-            return [
-                {'name': 'Sample Ad Unit 1', 'path': 'external/single_ad_samples'},
-                {'name': 'Sample Ad Unit 2', 'path': 'external/interactive_samples'}
-            ]
-            
-        if not self.client: return []
-        
+            yield {'name': 'Sample Ad Unit 1', 'path': 'external/single_ad_samples'}
+            yield {'name': 'Sample Ad Unit 2', 'path': 'external/interactive_samples'}
+            return
+
+        if not self.client: return
+
         inventory_service = self.client.GetService('InventoryService', version='v202408')
         statement = ad_manager.StatementBuilder(version='v202408')
-        
-        ad_units = []
-        response = inventory_service.getAdUnitsByStatement(statement.ToStatement())
-        if 'results' in response and response['results']:
+        statement.limit = 500
+
+        while True:
+            response = inventory_service.getAdUnitsByStatement(statement.ToStatement())
+            if 'results' not in response or not response['results']:
+                return
             for ad_unit in response['results']:
-                ad_units.append({
+                yield {
                     'name': ad_unit['name'],
                     'path': ad_unit['adUnitCode']
-                })
-        return ad_units
+                }
+            statement.offset += statement.limit
+
+    def list_ad_units(self):
+        """Fetch list of ad units for verification"""
+        return list(self.iter_ad_units())
@@ -7,11 +7,35 @@ hls_local_playback_demo.py
 - Local Playback (Auto Video/Audio Sink).
 """
 
+import concurrent.futures
+import contextlib
+import functools
 import sys
 import time
+import logging
 import os
+import fcntl
+import urllib.error
 import urllib.request
-import xml.etree.ElementTree as ET
+# Shared keep-alive pool: repeat VAST fetches and impression beacons
+# reuse warm TLS connections instead of paying a handshake per request;
+# plain urllib stays as the fallback
+try:
+    import urllib3
+    _HTTP = urllib3.PoolManager(
+        num_pools=2, maxsize=4,
+        retries=urllib3.Retry(3, backoff_factor=0.2))
+except ImportError:
+    _HTTP = None
+# lxml's C parser is several times faster on the VAST documents fetched
+# every ad rotation and lets us disable entity resolution outright;
+# stdlib ElementTree stays as the fallback
+try:
+    from lxml import etree as ET
+    _VAST_PARSE_OPTS = {"resolve_entities": False, "huge_tree": False}
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _VAST_PARSE_OPTS = {}
 
 # macOS: Initialize Cocoa BEFORE importing GStreamer
 if sys.platform == 'darwin':
@@ -23,8 +47,9 @@ if sys.platform == 'darwin':
 
 import gi
 gi.require_version('Gst', '1.0')
+gi.require_version('GstApp', '1.0')
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gst, Gtk, GLib
+from gi.repository import Gst, GstApp, Gtk, GLib
 
 try:
     from gam_api_helper import GAMAPIHelper
@@ -34,8 +59,44 @@ except ImportError:
 
 Gst.init(None)
 
+# Prefer a hardware H.264 decoder when the platform ships one
+# (vtdec_hw on macOS, VAAPI/NVDEC on Linux); avdec_h264 stays the fallback
+for _name in ("vtdec_hw", "vaapih264dec", "nvh264dec"):
+    _feature = Gst.Registry.get().find_feature(_name, Gst.ElementFactory)
+    if _feature:
+        _feature.set_rank(Gst.Rank.PRIMARY + 1)
+        break
+
+# Composite on the GPU when a GL stack is present; CPU compositor stays
+# the fallback
+_HAS_GL = bool(Gst.ElementFactory.find("glvideomixer")
+               and Gst.ElementFactory.find("glimagesink"))
+
+# videoconvertscale (GStreamer >= 1.20) does convert+scale in a single
+# pass over the frame; keep the two-element form for older installs
+if Gst.ElementFactory.find("videoconvertscale"):
+    _CONVERTSCALE = "videoconvertscale"
+else:
+    _CONVERTSCALE = "videoconvert ! videoscale"
+
+# logging formats lazily and only when a record is actually emitted,
+# unlike the old strftime + f-string per call; raise to DEBUG to see
+# per-element state transitions
+logging.basicConfig(format="[%(asctime)s] %(message)s", datefmt="%H:%M:%S",
+                    level=logging.INFO)
+logger = logging.getLogger("adcomp")
+
 def log(msg):
-    print(f"[{time.strftime('%H:%M:%S')}] {msg}")
+    logger.info("%s", msg)
+
+
+@functools.lru_cache(maxsize=16)
+def _build_caps(fmt, width, height, fps=0):
+    """One parsed Gst.Caps per format/size; refcounted, safe to share"""
+    s = f"video/x-raw,format={fmt},width={width},height={height}"
+    if fps:
+        s += f",framerate={fps}/1"
+    return Gst.Caps.from_string(s)
 
 class LocalAdCompositor:
     def __init__(self, main_url, ad_urls=None, vast_url=None, ad_positions=None, ad_width=320, ad_height=180, interval=20):
@@ -62,27 +123,61 @@ class LocalAdCompositor:
         self.restart_timer_id = None
         self.retry_count = 0
         self.impression_urls = []
+        # Resolved VAST responses keyed by tag URL, honoring max-age
+        self._vast_cache = {}
+        # Single worker: VAST fetches stay serialized, just off-loop
+        self._vast_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         self.manual_position = False
+        self._stdin_buf = bytearray()
+        self._pos_parse_cache = {}
 
     def update_ad_position(self, x, y):
         """Update the ad position dynamically if the ad is running."""
         if not self.comp_pad:
             log("[AD] Position update ignored (no ad running)")
             return
+        # Skip no-op moves: each pad property set kicks off compositor
+        # reconfiguration downstream
+        if (self.comp_pad.get_property("xpos") == x
+                and self.comp_pad.get_property("ypos") == y):
+            self.manual_position = True
+            return
         log(f"[AD] Manually moving to ({x}, {y})")
-        self.comp_pad.set_property("xpos", x)
-        self.comp_pad.set_property("ypos", y)
+        self.comp_pad.freeze_notify()
+        try:
+            self.comp_pad.set_property("xpos", x)
+            self.comp_pad.set_property("ypos", y)
+        finally:
+            self.comp_pad.thaw_notify()
         self.manual_position = True
 
     def _on_stdin_input(self, channel, condition):
-        line = sys.stdin.readline().strip()
-        if not line:
+        # Non-blocking read: a partial line (no newline yet) must never
+        # stall the loop that drives the pipelines
+        try:
+            chunk = os.read(sys.stdin.fileno(), 4096)
+        except BlockingIOError:
             return True
-        
-        parts = line.split()
-        if not parts:
+        if not chunk:
             return True
+        self._stdin_buf.extend(chunk)
+        while b"\n" in self._stdin_buf:
+            raw, _, rest = self._stdin_buf.partition(b"\n")
+            self._stdin_buf = bytearray(rest)
+            self._handle_command(raw.decode(errors="replace").strip())
+        return True
+
+    def _handle_command(self, line):
+        if not line:
+            return
 
+        # Corner presets repeat; lines seen before skip split/int parsing
+        cached = self._pos_parse_cache.get(line)
+        if cached is not None:
+            self.update_ad_position(*cached)
+            return
+
+        parts = line.split()
         if parts[0] == "pos" and len(parts) >= 2:
             if parts[1] == "auto":
                 log("[AD] Resuming automatic rotation")
@@ -91,50 +186,71 @@ class LocalAdCompositor:
                 try:
                     x = int(parts[1])
                     y = int(parts[2])
+                    self._pos_parse_cache[line] = (x, y)
                     self.update_ad_position(x, y)
                 except ValueError:
                     log(f"[INPUT ERROR] Invalid coordinates: {parts[1]}, {parts[2]}")
             else:
                 log("[INPUT ERROR] Usage: 'pos <x> <y>' or 'pos auto'")
-        return True
 
     def _on_main_pad_added(self, element, pad):
+        # Both targets taken: skip the caps fetch/parse for the extra
+        # tracks (subtitles, alternate audio) the decoder announces
+        if self._main_video_sink_pad.is_linked() and self._main_audio_sink_pad.is_linked():
+            return
         caps = pad.get_current_caps()
         if not caps: return
         name = caps.get_structure(0).get_name()
         
         if name.startswith("video"):
-            sink = self.main_pipeline.get_by_name("main_video_queue").get_static_pad("sink")
-            if not sink.is_linked(): pad.link(sink)
+            if not self._main_video_sink_pad.is_linked():
+                pad.link(self._main_video_sink_pad)
         elif name.startswith("audio"):
-            sink = self.main_pipeline.get_by_name("main_audio_queue").get_static_pad("sink")
-            if not sink.is_linked(): pad.link(sink)
+            if not self._main_audio_sink_pad.is_linked():
+                pad.link(self._main_audio_sink_pad)
 
     def _create_main_pipeline(self):
+        if _HAS_GL:
+            # Inputs are uploaded once and blended as textures; the frame
+            # never comes back through system memory before display
+            out_chain = "glvideomixer name=comp ! glimagesink"
+            main_tail = "glupload ! glcolorconvert ! comp.sink_0"
+            ad_tail = "glupload ! glcolorconvert name=ad_link_src"
+        else:
+            out_chain = (f"compositor name=comp ! {_CONVERTSCALE} ! "
+                         "video/x-raw,width=1280,height=720 ! autovideosink")
+            main_tail = "comp.sink_0"
+            ad_tail = ('capsfilter name=ad_link_src '
+                       f'caps="video/x-raw,width={self.ad_width},height={self.ad_height}"')
+
         pipeline_str = f"""
-            compositor name=comp ! videoconvert ! videoscale ! 
-            video/x-raw,width=1280,height=720 ! autovideosink
-            
-            uridecodebin uri="{self.main_url}" name=main_src
-            
-            main_src. ! queue name=main_video_queue max-size-buffers=10 ! videoconvert ! videoscale ! comp.sink_0
-            
+            {out_chain}
+
+            uridecodebin3 uri="{self.main_url}" name=main_src
+
+            main_src. ! queue name=main_video_queue max-size-buffers=10 ! {_CONVERTSCALE} ! video/x-raw,width=1280,height=720 ! {main_tail}
+
             main_src. ! queue name=main_audio_queue max-size-buffers=10 ! audioconvert ! audioresample ! autoaudiosink
-            
+
             appsrc name=ad_appsrc is-live=true do-timestamp=true format=time !
             video/x-raw,format=I420,width={self.ad_width},height={self.ad_height} !
             queue name=ad_queue max-size-buffers=10 leaky=downstream !
-            videoconvert ! videoscale ! 
-            capsfilter name=ad_link_src caps="video/x-raw,width={self.ad_width},height={self.ad_height}"
+            {ad_tail}
         """
         log("Creating Local Playback Pipeline...")
         self.main_pipeline = Gst.parse_launch(pipeline_str)
         self.compositor = self.main_pipeline.get_by_name("comp")
         self.appsrc = self.main_pipeline.get_by_name("ad_appsrc")
         
-        caps = Gst.Caps.from_string(f"video/x-raw,format=I420,width={self.ad_width},height={self.ad_height},framerate=30/1")
+        caps = _build_caps("I420", self.ad_width, self.ad_height, fps=30)
         self.appsrc.set_property("caps", caps)
         
+
+        # Cache hot-path lookups once; get_by_name walks the whole bin by
+        # string comparison on every call
+        self._ad_link_src_pad = self.main_pipeline.get_by_name("ad_link_src").get_static_pad("src")
+        self._main_video_sink_pad = self.main_pipeline.get_by_name("main_video_queue").get_static_pad("sink")
+        self._main_audio_sink_pad = self.main_pipeline.get_by_name("main_audio_queue").get_static_pad("sink")
         main_src = self.main_pipeline.get_by_name("main_src")
         main_src.connect("pad-added", self._on_main_pad_added)
 
@@ -155,70 +271,174 @@ class LocalAdCompositor:
             warn, debug = msg.parse_warning()
             log(f"[MAIN WARNING] {warn}")
         elif msg.type == Gst.MessageType.INFO:
-            info, debug = msg.parse_info()
-            log(f"[MAIN INFO] {info}")
+            # parse_info/parse_state_changed are non-trivial GValue
+            # unpacks; skip them unless debug output is actually on
+            if logger.isEnabledFor(logging.DEBUG):
+                info, debug = msg.parse_info()
+                logger.debug("[MAIN INFO] %s", info)
         elif msg.type == Gst.MessageType.STATE_CHANGED:
-            if msg.src == self.main_pipeline:
+            if msg.src == self.main_pipeline and logger.isEnabledFor(logging.DEBUG):
                 old, new, pending = msg.parse_state_changed()
-                log(f"[MAIN STATE] {old.value_nick} -> {new.value_nick}")
+                logger.debug("[MAIN STATE] %s -> %s", old.value_nick, new.value_nick)
         return True
 
+    @staticmethod
+    def _open_url(url, headers=None):
+        """GET through the shared pool when urllib3 is available"""
+        if _HTTP is not None:
+            return _HTTP.request("GET", url, headers=headers or {},
+                                 preload_content=False)
+        request = urllib.request.Request(url, headers=headers or {})
+        return urllib.request.urlopen(request)
+
+    def _fire_impressions(self, urls):
+        """Fire VAST impression beacons off the main loop, best-effort"""
+        for url in urls:
+            try:
+                response = self._open_url(url)
+                response.read()
+                if hasattr(response, "release_conn"):
+                    response.release_conn()
+                else:
+                    response.close()
+            except Exception as e:
+                log(f"[VAST] Impression beacon failed: {e}")
+        if urls:
+            log(f"[VAST] Fired {len(urls)} impression beacon(s)")
+
+    @staticmethod
+    def _vast_max_age(headers):
+        """TTL from Cache-Control max-age; 0 means revalidate every time"""
+        for part in headers.get("Cache-Control", "").split(","):
+            part = part.strip()
+            if part.startswith("max-age="):
+                try:
+                    return max(0, int(part[8:]))
+                except ValueError:
+                    break
+        return 0
+
     def _fetch_vast_media_url(self):
+        now = time.time()
+        cached = self._vast_cache.get(self.vast_url)
+        if cached and now < cached["expires"]:
+            log("[VAST] Cache hit - skipping fetch and parse")
+            self.impression_urls = list(cached["impressions"])
+            return cached["best_url"]
+
         log(f"[VAST] Fetching: {self.vast_url[:60]}...")
         self.impression_urls = []
+        best_url, best_bitrate = None, 0
+        hdrs = {}
+        if cached:
+            # Revalidate instead of re-downloading the same document
+            if cached.get("etag"):
+                hdrs["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                hdrs["If-Modified-Since"] = cached["last_modified"]
         try:
-            with urllib.request.urlopen(self.vast_url) as response:
-                xml_data = response.read()
-            tree = ET.fromstring(xml_data)
-            for imp in tree.findall(".//Impression"):
-                if imp.text: self.impression_urls.append(imp.text.strip())
-            
-            best_url, best_bitrate = None, 0
-            for mf in tree.findall(".//MediaFile"):
-                if mf.get("type") == "video/mp4":
-                    bitrate = int(mf.get("bitrate", 0))
-                    if bitrate > best_bitrate and bitrate < 5000:
-                        best_bitrate, best_url = bitrate, mf.text.strip()
+            # Stream-parse straight off the socket: one pass instead of
+            # two .// walks, memory stays flat however big the VAST is,
+            # and parsing overlaps the download
+            with contextlib.closing(self._open_url(self.vast_url, hdrs)) as response:
+                # urllib3 reports 304 as a status, not an HTTPError
+                if getattr(response, "status", 200) == 304 and cached:
+                    log("[VAST] Not modified - reusing cached media URL")
+                    cached["expires"] = now + self._vast_max_age(response.headers)
+                    self.impression_urls = list(cached["impressions"])
+                    return cached["best_url"]
+                for _, elem in ET.iterparse(response, events=("end",), **_VAST_PARSE_OPTS):
+                    tag = elem.tag.rpartition('}')[2]
+                    if tag == "Impression":
+                        if elem.text: self.impression_urls.append(elem.text.strip())
+                    elif tag == "MediaFile":
+                        if elem.get("type") == "video/mp4":
+                            bitrate = int(elem.get("bitrate", 0))
+                            if bitrate > best_bitrate and bitrate < 5000:
+                                best_bitrate, best_url = bitrate, elem.text.strip()
+                    elem.clear()
+                headers = response.headers
+            self._vast_cache[self.vast_url] = {
+                "expires": now + self._vast_max_age(headers),
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "best_url": best_url,
+                "impressions": list(self.impression_urls),
+            }
             return best_url
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and cached:
+                log("[VAST] Not modified - reusing cached media URL")
+                cached["expires"] = now + self._vast_max_age(e.headers)
+                self.impression_urls = list(cached["impressions"])
+                return cached["best_url"]
+            log(f"[VAST ERROR] {e}")
         except Exception as e:
             log(f"[VAST ERROR] {e}")
         return None
 
-    def _create_ad_pipeline(self):
-        if not self.ad_url: return
-        appsink = Gst.ElementFactory.make("appsink", "ad_sink")
-        appsink.set_property("emit-signals", True)
-        appsink.set_property("sync", True)
-        appsink.connect("new-sample", self._on_new_ad_sample)
+    def _build_ad_pipeline_once(self):
+        """Build playbin + sink bin on first use; rotations re-arm them"""
+        if self.ad_pipeline: return
+        # fakesink only paces the branch (sync=true); frames are grabbed
+        # by a buffer probe on the capsfilter, skipping appsink's sample
+        # boxing and new-sample signal dispatch entirely
+        sink = Gst.ElementFactory.make("fakesink", "ad_sink")
+        sink.set_property("sync", True)
 
         sink_bin = Gst.Bin.new("ad_sink_bin")
         q = Gst.ElementFactory.make("queue")
-        conv = Gst.ElementFactory.make("videoconvert")
-        scale = Gst.ElementFactory.make("videoscale")
+        convscale = [Gst.ElementFactory.make("videoconvertscale")]
+        if convscale[0] is None:
+            convscale = [Gst.ElementFactory.make("videoconvert"),
+                         Gst.ElementFactory.make("videoscale")]
         caps = Gst.ElementFactory.make("capsfilter")
-        caps.set_property("caps", Gst.Caps.from_string(f"video/x-raw,width={self.ad_width},height={self.ad_height},format=I420"))
+        caps.set_property("caps", _build_caps("I420", self.ad_width, self.ad_height))
+        caps.get_static_pad("src").add_probe(
+            Gst.PadProbeType.BUFFER, self._on_ad_buffer)
         
-        for e in [q, conv, scale, caps, appsink]: sink_bin.add(e)
-        q.link(conv); conv.link(scale); scale.link(caps); caps.link(appsink)
+        chain = [q] + convscale + [caps, sink]
+        for e in chain: sink_bin.add(e)
+        for up, down in zip(chain, chain[1:]): up.link(down)
         sink_bin.add_pad(Gst.GhostPad.new("sink", q.get_static_pad("sink")))
 
-        self.ad_pipeline = Gst.ElementFactory.make("playbin", "ad_playbin")
-        self.ad_pipeline.set_property("uri", self.ad_url)
+        self.ad_pipeline = Gst.ElementFactory.make("playbin3", "ad_playbin")
         self.ad_pipeline.set_property("video-sink", sink_bin)
         self.ad_pipeline.set_property("volume", 0.0)
+        self.ad_pipeline.connect("element-setup", self._on_ad_element_setup)
 
         bus = self.ad_pipeline.get_bus()
         bus.add_signal_watch()
         bus.connect("message", self._on_ad_message)
 
-    def _on_new_ad_sample(self, appsink):
-        if not self.ad_running or not self.appsrc: return Gst.FlowReturn.OK
-        sample = appsink.emit("pull-sample")
-        if sample:
-            buf = sample.get_buffer()
-            buf.pts = buf.dts = buf.duration = Gst.CLOCK_TIME_NONE
-            self.appsrc.emit("push-buffer", buf)
-        return Gst.FlowReturn.OK
+    def _on_ad_element_setup(self, playbin, element):
+        """Lower queue2 watermarks so progressive MP4 ads start right away"""
+        factory = element.get_factory()
+        if factory is None or factory.get_name() != "queue2":
+            return
+        # The default 99% high watermark makes buffering wait until the
+        # queue is nearly full before playback may begin
+        if element.find_property("high-watermark") is not None:
+            element.set_property("high-watermark", 0.10)
+            element.set_property("low-watermark", 0.01)
+        else:
+            element.set_property("high-percent", 10)
+            element.set_property("low-percent", 1)
+
+    def _arm_ad_pipeline(self):
+        self._build_ad_pipeline_once()
+        self.ad_pipeline.set_property("uri", self.ad_url)
+        self.ad_pipeline.set_state(Gst.State.PLAYING)
+
+    def _on_ad_buffer(self, pad, info):
+        if not self.ad_running or not self.appsrc: return Gst.PadProbeReturn.OK
+        # Shallow copy (planes stay shared) so clearing the PTS can't
+        # touch the buffer continuing into the pacing sink; do-timestamp
+        # on the appsrc then restamps it on push
+        buf = info.get_buffer().copy()
+        buf.pts = Gst.CLOCK_TIME_NONE
+        self.appsrc.push_buffer(buf)
+        return Gst.PadProbeReturn.OK
 
     def _on_ad_message(self, bus, msg):
         if msg.type == Gst.MessageType.EOS:
@@ -239,22 +459,39 @@ class LocalAdCompositor:
     def _stop_ad_pipeline(self):
         self.ad_running = False
         if self.comp_pad:
-            ad_src_elem = self.main_pipeline.get_by_name("ad_link_src")
-            ad_src_elem.get_static_pad("src").unlink(self.comp_pad)
+            self._ad_link_src_pad.unlink(self.comp_pad)
             self.compositor.release_request_pad(self.comp_pad)
             self.comp_pad = None
         if self.ad_pipeline:
-            self.ad_pipeline.set_state(Gst.State.NULL)
-            self.ad_pipeline = None
+            # READY keeps the warm sink bin and its elements around for
+            # the next rotation; NULL happens only on final cleanup
+            self.ad_pipeline.set_state(Gst.State.READY)
 
     def _restart_ad(self):
         self.restart_timer_id = None
         if self.vast_url:
-            self.ad_url = self._fetch_vast_media_url()
-        elif self.ad_urls:
+            # The VAST fetch blocks on network I/O; run it on the worker
+            # and marshal the result back, so the main loop keeps driving
+            # the compositor and bus while the request is in flight
+            fut = self._vast_executor.submit(self._fetch_vast_media_url)
+            fut.add_done_callback(
+                lambda f: GLib.idle_add(self._on_vast_ready, f.result()))
+            return False
+        if self.ad_urls:
             self.ad_url = self.ad_urls[self.ad_index]
             self.ad_index = (self.ad_index + 1) % len(self.ad_urls)
-        
+        return self._start_ad()
+
+    def _on_vast_ready(self, media_url):
+        self.ad_url = media_url
+        if media_url and self.impression_urls:
+            # Fire-and-forget on the worker so beacons never stall the loop
+            self._vast_executor.submit(
+                self._fire_impressions, list(self.impression_urls))
+        self._start_ad()
+        return False
+
+    def _start_ad(self):
         if not self.ad_url:
             self._schedule_restart()
             return False
@@ -271,16 +508,21 @@ class LocalAdCompositor:
             log(f"[AD] Playing at ({x}, {y}) - {self.ad_url[:40]}...")
             self.pos_index = (self.pos_index + 1) % len(self.ad_positions)
 
-        self.comp_pad.set_property("xpos", x)
-        self.comp_pad.set_property("ypos", y)
-        self.comp_pad.set_property("width", self.ad_width)
-        self.comp_pad.set_property("height", self.ad_height)
-        self.comp_pad.set_property("zorder", 100)
+        # Batch the notifies so the compositor re-layouts once, not five
+        # times
+        self.comp_pad.freeze_notify()
+        try:
+            self.comp_pad.set_property("xpos", x)
+            self.comp_pad.set_property("ypos", y)
+            self.comp_pad.set_property("width", self.ad_width)
+            self.comp_pad.set_property("height", self.ad_height)
+            self.comp_pad.set_property("zorder", 100)
+        finally:
+            self.comp_pad.thaw_notify()
         
-        self.main_pipeline.get_by_name("ad_link_src").get_static_pad("src").link(self.comp_pad)
-        self._create_ad_pipeline()
+        self._ad_link_src_pad.link(self.comp_pad)
         self.ad_running = True
-        self.ad_pipeline.set_state(Gst.State.PLAYING)
+        self._arm_ad_pipeline()
         return False
 
     def run(self):
@@ -289,6 +531,9 @@ class LocalAdCompositor:
         log("Commands: 'pos <x> <y>' to move ad, 'pos auto' to resume rotation")
         
         # Monitor stdin for user input
+        fd = sys.stdin.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
         GLib.io_add_watch(sys.stdin, GLib.IO_IN, self._on_stdin_input)
         
         self._create_main_pipeline()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+numpy_overlay_fast_path.py
+- Fast-path PiP overlay without the compositor element.
+- The 320x180 I420 ad is blitted onto the 1280x720 main frame with three
+  NumPy slice assignments (plain memmoves) instead of compositor's generic
+  per-pixel blend loop.
+- Main Pipeline: appsink (I420) -> NumPy blit -> appsrc.
+- Ad Pipeline: decoupled, caches the latest decoded ad planes.
+"""
+
+import sys
+import time
+
+# macOS: Initialize Cocoa BEFORE importing GStreamer
+if sys.platform == 'darwin':
+    try:
+        import AppKit
+        AppKit.NSApplication.sharedApplication()
+    except ImportError:
+        print("Note: PyObjC not installed")
+
+import numpy as np
+
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstApp', '1.0')
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gst, GstApp, Gtk, GLib
+
+Gst.init(None)
+
+def log(msg):
+    print(f"[{time.strftime('%H:%M:%S')}] {msg}")
+
+class NumpyOverlayCompositor:
+    """
+    PiP overlay via direct I420 plane writes instead of `compositor`.
+    The ad rectangle is a straight copy (no alpha), so three slice
+    assignments into the mapped main frame replace the blend element.
+    """
+    def __init__(self, main_url, ad_url, ad_x=920, ad_y=500, ad_width=320, ad_height=180):
+        self.main_url = main_url
+        self.ad_url = ad_url
+        # Chroma planes are subsampled 2x, keep offsets even
+        self.ad_x = ad_x & ~1
+        self.ad_y = ad_y & ~1
+        self.ad_width = ad_width
+        self.ad_height = ad_height
+        self.width = 1280
+        self.height = 720
+
+        self.main_pipeline = None
+        self.ad_pipeline = None
+        self.composed_src = None
+        self.ad_planes = None  # (Y, U, V) ndarrays of the latest ad frame
+        self.running = True
+
+    def _create_main_pipeline(self):
+        pipeline_str = f"""
+            uridecodebin uri="{self.main_url}" name=main_src
+
+            main_src. ! queue name=main_video_queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream !
+            videoconvert ! videoscale !
+            video/x-raw,format=I420,width={self.width},height={self.height} !
+            appsink name=main_yuv
+
+            main_src. ! queue name=audio_queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream !
+            audioconvert ! audioresample ! autoaudiosink
+
+            appsrc name=composed_yuv is-live=true format=time !
+            video/x-raw,format=I420,width={self.width},height={self.height} !
+            videoconvert ! autovideosink
+        """
+        self.main_pipeline = Gst.parse_launch(pipeline_str)
+
+        self.composed_src = self.main_pipeline.get_by_name("composed_yuv")
+        self.composed_src.set_property("caps", Gst.Caps.from_string(
+            f"video/x-raw,format=I420,width={self.width},height={self.height}"
+        ))
+
+        main_yuv = self.main_pipeline.get_by_name("main_yuv")
+        main_yuv.set_property("emit-signals", True)
+        main_yuv.set_property("sync", True)
+        main_yuv.set_property("max-buffers", 2)
+        main_yuv.set_property("drop", True)
+        main_yuv.connect("new-sample", self._on_main_sample)
+
+        self._main_video_sink_pad = self.main_pipeline.get_by_name("main_video_queue").get_static_pad("sink")
+        self._audio_sink_pad = self.main_pipeline.get_by_name("audio_queue").get_static_pad("sink")
+
+        main_src = self.main_pipeline.get_by_name("main_src")
+        main_src.connect("pad-added", self._on_main_pad_added)
+
+        bus = self.main_pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self._on_main_message)
+
+    def _on_main_pad_added(self, element, pad):
+        # Both targets taken: skip the caps fetch/parse for the extra
+        # tracks (subtitles, alternate audio) the decoder announces
+        if self._main_video_sink_pad.is_linked() and self._audio_sink_pad.is_linked():
+            return
+        caps = pad.get_current_caps()
+        if not caps: return
+        name = caps.get_structure(0).get_name()
+
+        if name.startswith("video"):
+            if not self._main_video_sink_pad.is_linked():
+                pad.link(self._main_video_sink_pad)
+        elif name.startswith("audio"):
+            if not self._audio_sink_pad.is_linked():
+                pad.link(self._audio_sink_pad)
+
+    def _on_main_sample(self, appsink):
+        if not self.running:
+            return Gst.FlowReturn.OK
+        sample = appsink.pull_sample()
+        if not sample:
+            return Gst.FlowReturn.OK
+        buf = sample.get_buffer()
+        # Drop the sample's buffer ref before mapping: a WRITE map needs
+        # a sole owner, and the extra ref would fail the writability
+        # check and silently skip the blit on every frame
+        del sample
+
+        planes = self.ad_planes
+        if planes is not None:
+            ok, info = buf.map(Gst.MapFlags.READ | Gst.MapFlags.WRITE)
+            if ok:
+                try:
+                    w, h = self.width, self.height
+                    frame = np.frombuffer(info.data, dtype=np.uint8)
+                    if frame.size == w * h * 3 // 2:
+                        y = frame[:w * h].reshape(h, w)
+                        u = frame[w * h:w * h + w * h // 4].reshape(h // 2, w // 2)
+                        v = frame[w * h + w * h // 4:].reshape(h // 2, w // 2)
+
+                        ax, ay = self.ad_x, self.ad_y
+                        aw, ah = self.ad_width, self.ad_height
+                        ad_y, ad_u, ad_v = planes
+                        # Three memmoves: NumPy slice assignment compiles to
+                        # contiguous row copies, no per-pixel blend checks
+                        y[ay:ay + ah, ax:ax + aw] = ad_y
+                        u[ay // 2:(ay + ah) // 2, ax // 2:(ax + aw) // 2] = ad_u
+                        v[ay // 2:(ay + ah) // 2, ax // 2:(ax + aw) // 2] = ad_v
+                finally:
+                    buf.unmap(info)
+
+        self.composed_src.push_buffer(buf)
+        return Gst.FlowReturn.OK
+
+    def _on_main_message(self, bus, msg):
+        if msg.type == Gst.MessageType.EOS:
+            log("[MAIN] EOS reached - quitting")
+            Gtk.main_quit()
+        elif msg.type == Gst.MessageType.ERROR:
+            err, debug = msg.parse_error()
+            log(f"[MAIN ERROR] {err}: {debug}")
+            Gtk.main_quit()
+        return True
+
+    def _create_ad_pipeline(self):
+        pipeline_str = f"""
+            uridecodebin3 uri="{self.ad_url}" name=ad_src use-buffering=false buffer-duration=0
+
+            ad_src. ! queue ! videoconvert ! videoscale !
+            video/x-raw,format=I420,width={self.ad_width},height={self.ad_height} !
+            appsink name=ad_sink
+
+            ad_src. ! audioconvert ! fakesink sync=false
+        """
+        self.ad_pipeline = Gst.parse_launch(pipeline_str)
+
+        appsink = self.ad_pipeline.get_by_name("ad_sink")
+        appsink.set_property("emit-signals", True)
+        appsink.set_property("sync", True)
+        appsink.set_property("max-buffers", 2)
+        appsink.set_property("drop", True)
+        appsink.connect("new-sample", self._on_ad_sample)
+
+        bus = self.ad_pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self._on_ad_message)
+
+    def _on_ad_sample(self, appsink):
+        if not self.running:
+            return Gst.FlowReturn.OK
+        sample = appsink.pull_sample()
+        if not sample:
+            return Gst.FlowReturn.OK
+        buf = sample.get_buffer()
+
+        ok, info = buf.map(Gst.MapFlags.READ)
+        if not ok:
+            return Gst.FlowReturn.OK
+        try:
+            w, h = self.ad_width, self.ad_height
+            data = np.frombuffer(info.data, dtype=np.uint8)
+            if data.size != w * h * 3 // 2:
+                return Gst.FlowReturn.OK
+            # Copy once here so the blit in the main callback reads from
+            # RAM we own, not a mapped buffer the decoder wants back
+            data = data.copy()
+        finally:
+            buf.unmap(info)
+
+        self.ad_planes = (
+            data[:w * h].reshape(h, w),
+            data[w * h:w * h + w * h // 4].reshape(h // 2, w // 2),
+            data[w * h + w * h // 4:].reshape(h // 2, w // 2),
+        )
+        return Gst.FlowReturn.OK
+
+    def _on_ad_message(self, bus, msg):
+        if msg.type == Gst.MessageType.EOS:
+            log("[AD] Looping...")
+            self.ad_pipeline.seek_simple(
+                Gst.Format.TIME,
+                Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
+                0
+            )
+        elif msg.type == Gst.MessageType.ERROR:
+            err, _ = msg.parse_error()
+            log(f"[AD ERROR] {err}")
+        return True
+
+    def run(self):
+        Gtk.init(None)
+        log("Starting NumPy fast-path overlay...")
+        self._create_main_pipeline()
+        self._create_ad_pipeline()
+
+        self.main_pipeline.set_state(Gst.State.PLAYING)
+        self.ad_pipeline.set_state(Gst.State.PLAYING)
+
+        try:
+            Gtk.main()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            self.main_pipeline.set_state(Gst.State.NULL)
+            self.ad_pipeline.set_state(Gst.State.NULL)
+
+if __name__ == "__main__":
+    main_hls = "https://indiatodaylive.akamaized.net/hls/live/2014320/indiatoday/indiatodaylive/live_720p/chunks.m3u8"
+    ad_mp4 = "https://www.w3schools.com/html/mov_bbb.mp4"
+
+    player = NumpyOverlayCompositor(main_url=main_hls, ad_url=ad_mp4)
+    player.run()
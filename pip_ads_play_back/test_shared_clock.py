@@ -3,9 +3,19 @@
 Redesigned test_shared_clock.py
 Uses decoupled pipelines: Main Pipeline (appsrc) + Ad Pipeline (appsink)
 Ensures HLS/SRT live stream never reaches EOS while ads loop at intervals.
+
+The cross-pipeline frame hand-off is zero-copy: each frame a plain
+Gst.Buffer.new() header takes the decoder's I420 planes by reference
+(replace_all_memory), so only a small header is allocated per frame
+and no plane bytes are copied between the ad pipeline and the main
+pipeline's appsrc.
 """
 
+import gc
 import sys
+import threading
+import concurrent.futures
+import itertools
 import time
 import os
 
@@ -19,10 +29,24 @@ if sys.platform == 'darwin':
 
 import gi
 gi.require_version('Gst', '1.0')
+gi.require_version('GstApp', '1.0')
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gst, Gtk, GLib
+from gi.repository import Gst, GstApp, Gtk, GLib
 import urllib.request
-import xml.etree.ElementTree as ET
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+# Network work (VAST fetches, tracking pixels) runs here, never on the
+# GLib main loop that drives the compositor
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+# Prefer lxml: libxml2 parses the VAST documents several-fold faster
+# and its findall/XPath run in C; stdlib ElementTree is the fallback
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 try:
     from gam_api_helper import GAMAPIHelper
@@ -32,6 +56,14 @@ except ImportError:
 
 Gst.init(None)
 
+# Prefer a hardware H.264 decoder when the platform ships one
+# (vtdec_hw on macOS, VAAPI/NVDEC on Linux); avdec_h264 stays the fallback
+for _name in ("vtdec_hw", "vaapih264dec", "nvh264dec"):
+    _feature = Gst.Registry.get().find_feature(_name, Gst.ElementFactory)
+    if _feature:
+        _feature.set_rank(Gst.Rank.PRIMARY + 1)
+        break
+
 def log(msg):
     print(f"[{time.strftime('%H:%M:%S')}] {msg}")
 
@@ -43,17 +75,27 @@ class DecoupledAdCompositor:
         self.main_url = main_url
         self.vast_url = vast_url
         self.ad_urls = ad_urls if isinstance(ad_urls, list) else ([ad_urls] if ad_urls else [])
-        self.ad_index = 0
+        # Endless rotation without index/modulo bookkeeping per cycle
+        self._ad_iter = itertools.cycle(self.ad_urls) if self.ad_urls else None
         
         # Positions should be list of (x, y) tuples. If None, uses hardcoded default.
         self.ad_positions = ad_positions if ad_positions else [(920, 500)]
-        self.pos_index = 0
+        self._pos_iter = itertools.cycle(self.ad_positions)
         
         self.ad_url = None
         self.ad_width = ad_width
         self.ad_height = ad_height
         self.interval = interval
 
+        # Parsed once here; caps-string parsing otherwise lands on the
+        # startup path of every (re)created pipeline
+        self._ad_caps = Gst.Caps.from_string(
+            f"video/x-raw,format=I420,width={ad_width},height={ad_height},framerate=30/1"
+        )
+        self._ad_sink_caps = Gst.Caps.from_string(
+            f"video/x-raw,width={ad_width},height={ad_height},format=I420"
+        )
+
         self.main_pipeline = None
         self.ad_pipeline = None
         self.compositor = None
@@ -63,36 +105,67 @@ class DecoupledAdCompositor:
         self.restart_timer_id = None
         self.retry_count = 0
         self.impression_urls = []
+        # Explicit ad timeline: stamped per frame instead of relying on
+        # appsrc do-timestamp, whose per-buffer clock reads make the
+        # compositor wait to align the first frame
+        self._ad_frame_dur = Gst.util_uint64_scale(Gst.SECOND, 1, 30)
+        self._ad_timeline_pts = 0
+        # Rejected pushes can repeat at frame rate while the pipeline is
+        # already struggling; log them at most once a second
+        self._last_reject_log = 0.0
+        # Toggled by the appsrc's need-data/enough-data signals: real
+        # backpressure from the consumer, instead of doing the pool and
+        # push work only to have the leaky queue throw the frame away
+        self._ad_can_push = True
+        # Keep-alive pool shared by VAST fetches and tracking pixels:
+        # impressions to the same ad host reuse one TLS session instead
+        # of paying 1-2 RTTs of handshake each
+        self._http = urllib3.PoolManager(maxsize=8) if urllib3 else None
+        # vast_url -> (media_url, impressions, expires_at); honors the
+        # tag response's Cache-Control max-age so an unchanged creative
+        # skips the fetch and parse entirely
+        self._vast_cache = {}
+
+    def _on_source_setup(self, element, source):
+        """Tune souphttpsrc for HLS: bigger reads, reused TCP connections"""
+        for prop, value in (("blocksize", 65536), ("keep-alive", True),
+                            ("timeout", 5), ("retries", 2)):
+            if source.find_property(prop) is not None:
+                source.set_property(prop, value)
 
     def _on_main_pad_added(self, element, pad):
+        # Both targets taken: skip the caps fetch/parse for the extra
+        # tracks (subtitles, alternate audio) the decoder announces
+        if self._main_video_sink_pad.is_linked() and self._audio_sink_pad.is_linked():
+            return
         caps = pad.get_current_caps()
         if not caps: return
         name = caps.get_structure(0).get_name()
         
         if name.startswith("video"):
-            sink = self.main_pipeline.get_by_name("main_video_queue").get_static_pad("sink")
-            if not sink.is_linked():
-                pad.link(sink)
+            if not self._main_video_sink_pad.is_linked():
+                pad.link(self._main_video_sink_pad)
                 log("[MAIN] Video linked")
         elif name.startswith("audio"):
-            sink = self.main_pipeline.get_by_name("audio_queue").get_static_pad("sink")
-            if not sink.is_linked():
-                pad.link(sink)
+            if not self._audio_sink_pad.is_linked():
+                pad.link(self._audio_sink_pad)
                 log("[MAIN] Audio linked")
 
     def _create_main_pipeline(self):
+        # No videoconvert/videoscale after comp: the capsfilter makes the
+        # compositor blend straight into a 1280x720 canvas the sink accepts,
+        # saving a full-frame copy per output frame
         pipeline_str = f"""
-            compositor name=comp ! videoconvert ! videoscale ! video/x-raw,width=1280,height=720 ! autovideosink
+            compositor name=comp background=black ignore-inactive-pads=true latency=0 min-upstream-latency=0 ! video/x-raw,width=1280,height=720 ! autovideosink
             
-            uridecodebin uri="{self.main_url}" name=main_src
+            uridecodebin uri="{self.main_url}" name=main_src buffer-duration=0 buffer-size=1048576
             
-            main_src. ! queue name=main_video_queue max-size-buffers=10 ! videoconvert ! videoscale ! comp.sink_0
-            main_src. ! queue name=audio_queue max-size-buffers=10 ! audioconvert ! audioresample ! autoaudiosink
+            main_src. ! queue name=main_video_queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream ! videoconvert ! videoscale ! comp.sink_0
+            main_src. ! queue name=audio_queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream ! audioconvert ! audioresample ! autoaudiosink
             
-            appsrc name=ad_appsrc is-live=true do-timestamp=true format=time !
+            appsrc name=ad_appsrc is-live=true format=time min-latency=0 max-latency=0 !
             video/x-raw,format=I420,width={self.ad_width},height={self.ad_height} !
-            queue name=ad_queue max-size-buffers=10 leaky=downstream !
-            videoconvert ! videoscale ! 
+            queue name=ad_queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream !
             capsfilter name=ad_link_src caps="video/x-raw,width={self.ad_width},height={self.ad_height}"
         """
         self.main_pipeline = Gst.parse_launch(pipeline_str)
@@ -100,16 +173,51 @@ class DecoupledAdCompositor:
         self.appsrc = self.main_pipeline.get_by_name("ad_appsrc")
         
         # Explicitly set caps on appsrc to avoid negotiation failure
-        caps = Gst.Caps.from_string(f"video/x-raw,format=I420,width={self.ad_width},height={self.ad_height},framerate=30/1")
-        self.appsrc.set_property("caps", caps)
+        self.appsrc.set_property("caps", self._ad_caps)
+        # Keep the hand-off allocation-free: never block the ad thread and
+        # cap the internal queue by buffer count instead of bytes
+        self.appsrc.set_property("block", False)
+        self.appsrc.set_property("max-bytes", 4 * self.ad_width * self.ad_height * 3 // 2)
+        self.appsrc.set_property("max-buffers", 4)
+        self.appsrc.set_property("leaky-type", 2)  # leak downstream, never stall the ad thread
+        self.appsrc.connect("need-data", self._on_ad_need_data)
+        self.appsrc.connect("enough-data", self._on_ad_enough_data)
+
         
+        # Cache element and pad handles once; get_by_name walks the whole
+        # bin tree on every call
+        self._ad_link_src_pad = self.main_pipeline.get_by_name("ad_link_src").get_static_pad("src")
+        self._main_video_sink_pad = self.main_pipeline.get_by_name("main_video_queue").get_static_pad("sink")
+        self._audio_sink_pad = self.main_pipeline.get_by_name("audio_queue").get_static_pad("sink")
+
+        # One persistent compositor pad for the ad, linked up front and
+        # hidden via alpha between cycles: requesting/releasing sink_%u
+        # under running state costs pad blocking and renegotiation
+        self.comp_pad = self.compositor.request_pad_simple("sink_%u")
+        self.comp_pad.set_property("width", self.ad_width)
+        self.comp_pad.set_property("height", self.ad_height)
+        self.comp_pad.set_property("zorder", 100)
+        self.comp_pad.set_property("alpha", 0.0)
+        self._ad_link_src_pad.link(self.comp_pad)
+
         # Connect pad-added for uridecodebin
         main_src = self.main_pipeline.get_by_name("main_src")
         main_src.connect("pad-added", self._on_main_pad_added)
+        main_src.connect("source-setup", self._on_source_setup)
 
+        # Poll the main bus from a worker thread: qos/tag/latency spam
+        # never wakes the GTK main loop, only EOS/ERROR get dispatched
         bus = self.main_pipeline.get_bus()
-        bus.add_signal_watch()
-        bus.connect("message", self._on_main_message)
+        threading.Thread(target=self._main_bus_loop, args=(bus,), daemon=True).start()
+
+    def _main_bus_loop(self, bus):
+        """Blocking bus poll; masked messages are handed to the main loop"""
+        mask = Gst.MessageType.EOS | Gst.MessageType.ERROR
+        while True:
+            msg = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE, mask)
+            if msg is None:
+                return
+            GLib.idle_add(self._on_main_message, bus, msg)
 
     def _on_main_message(self, bus, msg):
         if msg.type == Gst.MessageType.EOS:
@@ -121,57 +229,99 @@ class DecoupledAdCompositor:
             # during dynamic pipeline changes. We treat it as a warning to avoid crashing.
             if "Quit requested" in str(err):
                 log(f"[MAIN WARNING] Transient sink error ignored: {err}")
-                return True
+                return False
             log(f"[MAIN ERROR] {err}: {debug}")
             Gtk.main_quit()
-        return True
+        return False
+
+    def _http_get(self, url):
+        """GET `url`, through pooled connections when urllib3 is present"""
+        if self._http is not None:
+            return self._http.request("GET", url, preload_content=False)
+        return urllib.request.urlopen(url)
 
     def _fire_tracking_url(self, url):
         """Fire a tracking pixel (Impression/Quartile) asynchronously"""
         log(f"[TRACKING] Firing pixel: {url[:60]}...")
         def _fire():
             try:
-                with urllib.request.urlopen(url) as response:
-                    response.read() # Just consume
+                response = self._http_get(url)
+                response.read() # Just consume
+                if hasattr(response, "release_conn"):
+                    response.release_conn()
+                else:
+                    response.close()
                 log("[TRACKING] Pixel fired successfully")
             except Exception as e:
                 log(f"[TRACKING ERROR] Failed to fire pixel: {e}")
-            return False
-        GLib.idle_add(_fire)
+        # idle_add would still run the blocking urlopen on the main
+        # loop; the pixel does not need the loop at all
+        _EXECUTOR.submit(_fire)
+
+    @staticmethod
+    def _vast_max_age(headers):
+        """TTL from Cache-Control max-age; 0 means refetch every time"""
+        for part in headers.get("Cache-Control", "").split(","):
+            part = part.strip()
+            if part.startswith("max-age="):
+                try:
+                    return max(0, int(part[8:]))
+                except ValueError:
+                    break
+        return 0
 
     def _fetch_vast_media_url(self):
         """Fetch VAST XML, extract impressions, and pick best MP4 bitrate"""
+        now = time.monotonic()
+        cached = self._vast_cache.get(self.vast_url)
+        if cached and now < cached[2]:
+            log("[VAST] Cache hit - reusing selected media URL")
+            self.impression_urls = list(cached[1])
+            return cached[0]
+
         log(f"[VAST] Fetching tag: {self.vast_url[:60]}...")
         self.impression_urls = []
+        best_url = None
+        best_bitrate = 0
         try:
-            with urllib.request.urlopen(self.vast_url) as response:
-                xml_data = response.read()
-            
-            tree = ET.fromstring(xml_data)
-            
-            # 1. Extract Impression pixels
-            impressions = tree.findall(".//Impression")
-            for imp in impressions:
-                if imp.text:
-                    self.impression_urls.append(imp.text.strip())
+            # Feed the socket into a pull parser: Impression and
+            # MediaFile elements are extracted as chunks arrive, peak
+            # memory stays at one chunk, and a 500 KB wrapper chain is
+            # never materialized as a DOM
+            parser = ET.XMLPullParser(events=("end",))
+            with self._http_get(self.vast_url) as response:
+                while True:
+                    chunk = response.read(16384)
+                    if not chunk:
+                        break
+                    parser.feed(chunk)
+                    for _, elem in parser.read_events():
+                        tag = elem.tag.rpartition('}')[2]
+                        if tag == "Impression":
+                            if elem.text:
+                                self.impression_urls.append(elem.text.strip())
+                        elif tag == "MediaFile":
+                            if elem.get("type") == "video/mp4":
+                                bitrate = int(elem.get("bitrate", 0))
+                                # Prefer higher bitrate but within reasonable range (e.g., < 5mbps for PiP)
+                                if bitrate > best_bitrate and bitrate < 5000:
+                                    best_bitrate = bitrate
+                                    best_url = elem.text.strip()
+                        elem.clear()
+                    # >= 2 Mbps is plenty for a PiP window; stop reading
+                    # instead of scanning the remaining renditions (VAST
+                    # puts Impression before the MediaFiles, so pixels
+                    # are already collected by now)
+                    if best_bitrate >= 2000:
+                        break
+                headers = getattr(response, "headers", {}) or {}
             log(f"[VAST] Found {len(self.impression_urls)} impression pixels")
 
-            # 2. Extract MediaFiles and pick best MP4
-            media_files = tree.findall(".//MediaFile")
-            best_url = None
-            best_bitrate = 0
-            
-            for mf in media_files:
-                if mf.get("type") == "video/mp4":
-                    url = mf.text.strip()
-                    bitrate = int(mf.get("bitrate", 0))
-                    # Prefer higher bitrate but within reasonable range (e.g., < 5mbps for PiP)
-                    if bitrate > best_bitrate and bitrate < 5000:
-                        best_bitrate = bitrate
-                        best_url = url
-            
             if best_url:
                 log(f"[VAST] Selected best MP4 with {best_bitrate} kbps")
+                self._vast_cache[self.vast_url] = (
+                    best_url, list(self.impression_urls),
+                    now + self._vast_max_age(headers))
                 return best_url
             
             log("[VAST ERROR] No MP4 media file found in VAST response")
@@ -180,67 +330,85 @@ class DecoupledAdCompositor:
         return None
 
     def _create_ad_pipeline(self):
-        """Create separate pipeline for ad playback using playbin for robustness"""
+        """Build or re-arm the hand-built ad pipeline (uridecodebin3 + appsink)"""
         if not self.ad_url:
             log("[AD ERROR] No ad URL available. Skipping...")
             return
+        if self.ad_pipeline:
+            # The graph from the last rotation is intact (parked at
+            # READY); only the uri changes per cycle, so the seven
+            # element allocations and links are a one-time cost
+            self.ad_pipeline.get_by_name("ad_src").set_property("uri", self.ad_url)
+            return
 
-        # Create appsink first
-        appsink = Gst.ElementFactory.make("appsink", "ad_sink")
-        appsink.set_property("emit-signals", True)
-        appsink.set_property("sync", True)
-        appsink.set_property("max-buffers", 5)
-        appsink.set_property("drop", True)
-        appsink.connect("new-sample", self._on_new_ad_sample)
-
-        # Build sink bin for playbin
-        sink_bin = Gst.Bin.new("ad_sink_bin")
-        queue = Gst.ElementFactory.make("queue", "ad_queue")
-        convert = Gst.ElementFactory.make("videoconvert", "ad_convert")
-        scale = Gst.ElementFactory.make("videoscale", "ad_scale")
-        caps = Gst.ElementFactory.make("capsfilter", "ad_caps")
-        caps.set_property("caps", Gst.Caps.from_string(
-            f"video/x-raw,width={self.ad_width},height={self.ad_height},format=I420"
-        ))
-
-        for elem in [queue, convert, scale, caps, appsink]:
-            sink_bin.add(elem)
-        
-        queue.link(convert)
-        convert.link(scale)
-        scale.link(caps)
-        caps.link(appsink)
+        # Hand-built pipeline: skips playbin's urisourcebin multiqueue and
+        # lets the boosted hardware decoder (see top of file) take the
+        # stream. Audio is decoded straight into a fakesink (silent ad).
+        pipeline_str = f"""
+            uridecodebin3 uri="{self.ad_url}" name=ad_src use-buffering=false buffer-duration=0
 
-        ghost = Gst.GhostPad.new("sink", queue.get_static_pad("sink"))
-        sink_bin.add_pad(ghost)
+            ad_src. ! queue name=ad_queue max-size-buffers=2 max-size-bytes=0 max-size-time=0 leaky=downstream ! videoconvert ! videoscale !
+            capsfilter name=ad_caps !
+            fakesink name=ad_sink sync=true
 
-        # Create playbin
-        self.ad_pipeline = Gst.ElementFactory.make("playbin", "ad_playbin")
-        self.ad_pipeline.set_property("uri", self.ad_url)
-        self.ad_pipeline.set_property("video-sink", sink_bin)
-        self.ad_pipeline.set_property("volume", 0.0) # Silent ad
+            ad_src. ! audioconvert ! fakesink sync=false
+        """
+        self.ad_pipeline = Gst.parse_launch(pipeline_str)
+        # Caps were parsed once in __init__; reuse the object instead of
+        # re-parsing the string per rotation
+        ad_caps = self.ad_pipeline.get_by_name("ad_caps")
+        ad_caps.set_property("caps", self._ad_sink_caps)
+        # The fakesink only paces the branch against the clock; frames
+        # are taken by a buffer probe, which skips appsink's per-frame
+        # g_signal_emit, closure lookup and sample boxing entirely
+        # (the C AppSinkCallbacks struct is not introspectable from
+        # Python, so the probe is the no-signal path available here)
+        ad_caps.get_static_pad("src").add_probe(
+            Gst.PadProbeType.BUFFER, self._on_ad_buffer)
 
         bus = self.ad_pipeline.get_bus()
         bus.add_signal_watch()
         bus.connect("message", self._on_ad_message)
 
-    def _on_new_ad_sample(self, appsink):
-        if not self.ad_running or not self.appsrc:
-            return Gst.FlowReturn.OK
+    def _on_ad_need_data(self, src, length):
+        self._ad_can_push = True
+
+    def _on_ad_enough_data(self, src):
+        self._ad_can_push = False
+
+    def _on_ad_buffer(self, pad, info):
+        if not self.ad_running or not self.appsrc or not self._ad_can_push:
+            # While the consumer is full the frame just continues into
+            # the pacing fakesink; no pool work, no push, no leak-drop
+            return Gst.PadProbeReturn.OK
         
-        sample = appsink.emit("pull-sample")
-        if sample:
-            buf = sample.get_buffer()
-            # Clear timestamps to let appsrc (do-timestamp=true) handle it
-            buf.pts = Gst.CLOCK_TIME_NONE
-            buf.dts = Gst.CLOCK_TIME_NONE
-            buf.duration = Gst.CLOCK_TIME_NONE
-            
-            # Push buffer to main pipeline appsrc
-            ret = self.appsrc.emit("push-buffer", buf)
-            if ret != Gst.FlowReturn.OK:
+        buf = info.get_buffer()
+        # Fresh lightweight header around the decoder's I420 planes,
+        # attached by reference: no plane memcpy, and the new header is
+        # writable for re-timestamping. (A pooled header would come back
+        # flagged TAG_MEMORY after replace_all_memory and the pool frees
+        # such buffers instead of recycling them.)
+        shared = Gst.Buffer.new()
+        shared.replace_all_memory(buf.get_all_memory())
+        # Smooth 30 fps ramp from the running time captured at ad start:
+        # downstream can schedule the first frame immediately and knows
+        # every frame's duration up front
+        shared.pts = self._ad_timeline_pts
+        shared.dts = Gst.CLOCK_TIME_NONE
+        shared.duration = self._ad_frame_dur
+        self._ad_timeline_pts += self._ad_frame_dur
+        
+        # Push buffer to main pipeline appsrc
+        ret = self.appsrc.push_buffer(shared)
+        if ret != Gst.FlowReturn.OK:
+            now = time.monotonic()
+            if now - self._last_reject_log > 1.0:
+                self._last_reject_log = now
                 log(f"[AD] Push rejected: {ret}")
-        return Gst.FlowReturn.OK
+        # Release our refs before returning; appsrc holds its own and
+        # lingering Python refs keep whole I420 frames alive
+        del buf, shared
+        return Gst.PadProbeReturn.OK
 
     def _on_ad_message(self, bus, msg):
         if msg.type == Gst.MessageType.EOS:
@@ -263,65 +431,66 @@ class DecoupledAdCompositor:
     def _stop_ad_pipeline(self):
         self.ad_running = False
         
-        # 1. Unlink and release compositor pad (Removes window)
+        # 1. Hide the window; the persistent pad and its link survive
+        # (ignore-inactive-pads keeps the idle branch out of the blend)
         if self.comp_pad:
-            ad_src_elem = self.main_pipeline.get_by_name("ad_link_src")
-            ad_src_pad = ad_src_elem.get_static_pad("src")
-            log(f"[COMPOSITOR] Releasing ad pad (Unlinking window)")
-            ad_src_pad.unlink(self.comp_pad)
-            self.compositor.release_request_pad(self.comp_pad)
-            self.comp_pad = None
-
-        # 2. Stop ad pipeline
+            log(f"[COMPOSITOR] Hiding ad window")
+            self.comp_pad.set_property("alpha", 0.0)
+
+        # 2. Park the ad pipeline at READY; the elements and their
+        # negotiated state stay warm for the next rotation (NULL only
+        # in run()'s final cleanup)
         if self.ad_pipeline:
-            self.ad_pipeline.set_state(Gst.State.NULL)
-            self.ad_pipeline = None
+            self.ad_pipeline.set_state(Gst.State.READY)
 
     def _restart_ad(self):
         self.restart_timer_id = None
         
         if self.vast_url:
             log("[AD] Refreshing VAST and restarting fresh (Adding window)...")
-            self.ad_url = self._fetch_vast_media_url()
+            # The HTTPS round trip runs on the worker pool; the result
+            # is marshalled back so pad setup stays on the main loop
+            fut = _EXECUTOR.submit(self._fetch_vast_media_url)
+            fut.add_done_callback(
+                lambda f: GLib.idle_add(self._on_vast_fetched, f.result()))
+            return False
         elif self.ad_urls:
-            self.ad_url = self.ad_urls[self.ad_index]
-            log(f"[AD] Playing from pool (Index {self.ad_index}): {self.ad_url[:60]}...")
-            self.ad_index = (self.ad_index + 1) % len(self.ad_urls)
+            self.ad_url = next(self._ad_iter)
+            log(f"[AD] Playing from pool: {self.ad_url[:60]}...")
         else:
             log("[AD ERROR] No ad source (VAST or Pool) available.")
             self._schedule_restart()
             return False
+        return self._on_vast_fetched(self.ad_url)
 
+    def _on_vast_fetched(self, media_url):
+        self.ad_url = media_url
         if not self.ad_url:
             log("[AD] Ad source fetch failed, retrying later...")
             self._schedule_restart()
             return False
 
-        # 1. Request new pad from compositor
-        self.comp_pad = self.compositor.request_pad_simple("sink_%u")
-        
-        # Rotational Positioning
-        x, y = self.ad_positions[self.pos_index]
+        # 1. Rotational positioning on the persistent pad, then unhide
+        x, y = next(self._pos_iter)
         log(f"[COMPOSITOR] Setting window position to ({x}, {y})")
-        self.comp_pad.set_property("xpos", x)
-        self.comp_pad.set_property("ypos", y)
-        self.pos_index = (self.pos_index + 1) % len(self.ad_positions)
-        
-        self.comp_pad.set_property("width", self.ad_width)
-        self.comp_pad.set_property("height", self.ad_height)
-        self.comp_pad.set_property("zorder", 100)
-        
-        # 2. Link appsrc chain to compositor
-        ad_src_elem = self.main_pipeline.get_by_name("ad_link_src")
-        ad_src_pad = ad_src_elem.get_static_pad("src")
-        ad_src_pad.link(self.comp_pad)
-        
-        # 3. Create and start ad source pipeline
+        self.comp_pad.freeze_notify()
+        try:
+            self.comp_pad.set_property("xpos", x)
+            self.comp_pad.set_property("ypos", y)
+            self.comp_pad.set_property("alpha", 1.0)
+        finally:
+            self.comp_pad.thaw_notify()
+        # 2. Create and start ad source pipeline
         self._create_ad_pipeline()
+        # Anchor the explicit timeline at the pipeline's current running
+        # time so this ad's frames land "now", never behind the segment
+        clock = self.main_pipeline.get_clock()
+        if clock:
+            self._ad_timeline_pts = clock.get_time() - self.main_pipeline.get_base_time()
         self.ad_running = True
         self.ad_pipeline.set_state(Gst.State.PLAYING)
         
-        # 4. Fire impression pixels (GAM POC)
+        # 3. Fire impression pixels (GAM POC)
         for url in self.impression_urls:
             self._fire_tracking_url(url)
             
@@ -340,6 +509,9 @@ class DecoupledAdCompositor:
         # Trigger first ad play immediately manually
         self._restart_ad()
 
+        # Safety net against buffer-ref pile-ups across ad cycles
+        GLib.timeout_add_seconds(5, lambda: (gc.collect(), True)[1])
+
         try:
             Gtk.main()
         except KeyboardInterrupt:
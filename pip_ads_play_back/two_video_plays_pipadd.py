@@ -1,13 +1,10 @@
 #!/usr/bin/env python3
 """
 Test: Composite two MP4 videos (main + overlay) with looping
-Main video plays once, overlay loops continuously using imagefreeze workaround
+Main video plays once, overlay loops continuously via segment seeks
 """
 
 import sys
-import subprocess
-import tempfile
-import os
 
 # macOS: Initialize Cocoa BEFORE importing GStreamer
 if sys.platform == 'darwin':
@@ -28,6 +25,10 @@ Gst.init(None)
 class VideoCompositor:
     """Composite two videos: main video with looping PIP overlay"""
 
+    # Shared by every capsfilter that enforces the output size, so the
+    # caps are parsed once and refcounted instead of re-created
+    OUTPUT_CAPS = Gst.Caps.from_string("video/x-raw,width=1280,height=720")
+
     def __init__(self, main_url, overlay_url, overlay_x=640, overlay_y=360, overlay_width=320, overlay_height=180):
         self.main_url = main_url
         self.overlay_url = overlay_url
@@ -36,93 +37,142 @@ class VideoCompositor:
         self.overlay_width = overlay_width
         self.overlay_height = overlay_height
         self.pipeline = None
-        self.looped_overlay_file = None
-
-    def _create_looped_overlay(self, loop_count=100):
-        """Pre-create a looped version of the overlay video using FFmpeg"""
-        print(f"[SETUP] Creating looped overlay video ({loop_count} loops)...")
-
-        # Create temp file
-        self.looped_overlay_file = tempfile.mktemp(suffix=".mp4")
-
-        # Use FFmpeg to loop the video
-        cmd = [
-            "ffmpeg", "-y",
-            "-stream_loop", str(loop_count - 1),
-            "-i", self.overlay_url,
-            "-c", "copy",
-            "-t", "3600",  # Max 1 hour
-            self.looped_overlay_file
-        ]
+        self._loop_armed = False
 
-        try:
-            result = subprocess.run(cmd, capture_output=True, timeout=60)
-            if result.returncode == 0:
-                print(f"[SETUP] Looped overlay created: {self.looped_overlay_file}")
-                return True
-            else:
-                print(f"[SETUP] FFmpeg failed: {result.stderr.decode()[:200]}")
-                return False
-        except Exception as e:
-            print(f"[SETUP] FFmpeg error: {e}")
+    def _create_pipeline(self):
+        """Create compositing pipeline (factory-built, no parse_launch)"""
+        self.pipeline = Gst.Pipeline.new("compositor")
+        make = Gst.ElementFactory.make
+
+        comp = make("compositor", "comp")
+        out_conv = make("videoconvert")
+        out_scale = make("videoscale")
+        out_caps = make("capsfilter")
+        video_sink = make("autovideosink")
+
+        main_src = make("uridecodebin", "main_src")
+        main_q = make("queue")
+        main_conv = make("videoconvert")
+        main_scale = make("videoscale")
+        main_caps = make("capsfilter")
+
+        audio_q = make("queue")
+        audio_conv = make("audioconvert")
+        audio_resample = make("audioresample")
+        audio_sink = make("autoaudiosink")
+
+        overlay_src = make("uridecodebin", "overlay_src")
+        overlay_q = make("queue")
+        overlay_conv = make("videoconvert")
+        overlay_scale = make("videoscale")
+        overlay_caps = make("capsfilter")
+
+        chains = [
+            (comp, out_conv, out_scale, out_caps, video_sink),
+            (main_q, main_conv, main_scale, main_caps),
+            (audio_q, audio_conv, audio_resample, audio_sink),
+            (overlay_q, overlay_conv, overlay_scale, overlay_caps),
+        ]
+        elements = [main_src, overlay_src] + [e for chain in chains for e in chain]
+        if any(e is None for e in elements):
+            print("[ERROR] Pipeline failed: missing GStreamer element")
             return False
 
-    def _create_pipeline(self):
-        """Create compositing pipeline"""
-
-        # Use the looped file if available, otherwise use original
-        overlay_uri = f"file://{self.looped_overlay_file}" if self.looped_overlay_file else self.overlay_url
-
-        pipeline_str = f"""
-            compositor name=comp
-                sink_0::zorder=0
-                sink_1::zorder=1
-                sink_1::xpos={self.overlay_x}
-                sink_1::ypos={self.overlay_y}
-                sink_1::width={self.overlay_width}
-                sink_1::height={self.overlay_height} !
-            videoconvert !
-            videoscale !
-            video/x-raw,width=1280,height=720 !
-            autovideosink
-
-            uridecodebin uri="{self.main_url}" name=main_src !
-            queue max-size-buffers=5 !
-            videoconvert !
-            videoscale !
-            video/x-raw,width=1280,height=720 !
-            comp.sink_0
-
-            main_src. !
-            queue max-size-buffers=5 !
-            audioconvert !
-            audioresample !
-            autoaudiosink
-
-            uridecodebin uri="{overlay_uri}" name=overlay_src !
-            queue max-size-buffers=5 !
-            videoconvert !
-            videoscale !
-            video/x-raw,width={self.overlay_width},height={self.overlay_height} !
-            comp.sink_1
-        """
+        main_src.set_property("uri", self.main_url)
+        overlay_src.set_property("uri", self.overlay_url)
+        for q in (main_q, audio_q, overlay_q):
+            q.set_property("max-size-buffers", 5)
+        # The same caps object caps both the compositor output and the
+        # main branch; the overlay gets its own size
+        out_caps.set_property("caps", self.OUTPUT_CAPS)
+        main_caps.set_property("caps", self.OUTPUT_CAPS)
+        overlay_caps.set_property("caps", Gst.Caps.from_string(
+            f"video/x-raw,width={self.overlay_width},height={self.overlay_height}"))
+
+        for e in elements:
+            self.pipeline.add(e)
+        for chain in chains:
+            for up, down in zip(chain, chain[1:]):
+                up.link(down)
+
+        main_pad = comp.request_pad_simple("sink_%u")
+        main_pad.set_property("zorder", 0)
+        main_caps.get_static_pad("src").link(main_pad)
+
+        overlay_pad = comp.request_pad_simple("sink_%u")
+        overlay_pad.set_property("zorder", 1)
+        overlay_pad.set_property("xpos", self.overlay_x)
+        overlay_pad.set_property("ypos", self.overlay_y)
+        overlay_pad.set_property("width", self.overlay_width)
+        overlay_pad.set_property("height", self.overlay_height)
+        overlay_caps.get_static_pad("src").link(overlay_pad)
+
+        # Decoder pads appear only once streams are discovered
+        self._main_video_sink_pad = main_q.get_static_pad("sink")
+        self._audio_sink_pad = audio_q.get_static_pad("sink")
+        self._overlay_sink_pad = overlay_q.get_static_pad("sink")
+        main_src.connect("pad-added", self._on_decoder_pad_added)
+        overlay_src.connect("pad-added", self._on_decoder_pad_added)
+
+        # Setup bus
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self._on_message)
 
-        try:
-            self.pipeline = Gst.parse_launch(pipeline_str)
-
-            # Setup bus
-            bus = self.pipeline.get_bus()
-            bus.add_signal_watch()
-            bus.connect("message", self._on_message)
+        return True
 
-            return True
-        except GLib.Error as e:
-            print(f"[ERROR] Pipeline failed: {e}")
-            return False
+    def _on_decoder_pad_added(self, element, pad):
+        # All three targets taken: skip the caps fetch/parse for any
+        # extra tracks the decoders announce
+        if (self._main_video_sink_pad.is_linked()
+                and self._audio_sink_pad.is_linked()
+                and self._overlay_sink_pad.is_linked()):
+            return
+        caps = pad.get_current_caps()
+        if not caps:
+            return
+        name = caps.get_structure(0).get_name()
+
+        if name.startswith("video"):
+            target = (self._main_video_sink_pad
+                      if element.get_name() == "main_src"
+                      else self._overlay_sink_pad)
+            if not target.is_linked():
+                pad.link(target)
+        elif name.startswith("audio") and element.get_name() == "main_src":
+            if not self._audio_sink_pad.is_linked():
+                pad.link(self._audio_sink_pad)
+
+    def _arm_overlay_loop(self):
+        """Put the overlay branch into segment mode so it never EOSes"""
+        overlay_src = self.pipeline.get_by_name("overlay_src")
+        overlay_src.seek(1.0, Gst.Format.TIME,
+                         Gst.SeekFlags.FLUSH | Gst.SeekFlags.SEGMENT,
+                         Gst.SeekType.SET, 0,
+                         Gst.SeekType.NONE, -1)
 
     def _on_message(self, bus, msg):
-        if msg.type == Gst.MessageType.EOS:
+        if msg.type == Gst.MessageType.ASYNC_DONE:
+            # First preroll: switch the overlay branch to segment mode
+            if not self._loop_armed:
+                self._loop_armed = True
+                self._arm_overlay_loop()
+
+        elif msg.type == Gst.MessageType.SEGMENT_DONE:
+            # Overlay segment finished: rewind it in place. Non-flushing
+            # segment seeks accumulate running time, so the restart is
+            # seamless and the main branch never notices
+            overlay_src = self.pipeline.get_by_name("overlay_src")
+            overlay_src.seek(1.0, Gst.Format.TIME, Gst.SeekFlags.SEGMENT,
+                             Gst.SeekType.SET, 0,
+                             Gst.SeekType.NONE, -1)
+
+        elif msg.type == Gst.MessageType.EOS:
             print("[MAIN] Stream ended, looping...")
+            # The pipeline-wide flushing seek also knocks the overlay
+            # branch out of segment mode; re-arm it on the ASYNC_DONE
+            # that follows or the overlay freezes after the first pass
+            self._loop_armed = False
             self.pipeline.seek_simple(
                 Gst.Format.TIME,
                 Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
@@ -153,10 +203,6 @@ class VideoCompositor:
         print(f"  Overlay position: ({self.overlay_x}, {self.overlay_y})")
         print(f"  Overlay size: {self.overlay_width}x{self.overlay_height}")
 
-        # Create looped overlay file
-        if not self._create_looped_overlay():
-            print("[WARNING] Using original overlay (may not loop)")
-
         if not self._create_pipeline():
             return
 
@@ -171,10 +217,6 @@ class VideoCompositor:
             print("\nStopping...")
         finally:
             self.pipeline.set_state(Gst.State.NULL)
-            # Cleanup temp file
-            if self.looped_overlay_file and os.path.exists(self.looped_overlay_file):
-                os.remove(self.looped_overlay_file)
-                print(f"[CLEANUP] Removed temp file")
 
         print("Done.")
 